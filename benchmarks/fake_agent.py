@@ -0,0 +1,262 @@
+# Offline stand-in for the SSM agent side of Session Manager port sessions
+#
+# FakeAgent is a local WebSocket server speaking the data channel protocol the
+# way the agent does: it sends the handshake request, acknowledges every
+# message, and forwards the stream data to a local TCP port, multiplexed with
+# smux for agent versions newer than 3.0.196.0.  Attached to a FakeFleet, the
+# StartSession calls of the fleet return stream URLs of the agent, so the native
+# port forwarding of toolkit.datachannel can be exercised without AWS.
+#
+# The agent side frames its messages itself, following the layout of the
+# session-manager-plugin, instead of using toolkit.datachannel: a mistake in
+# the client's framing then shows up as a failing session rather than being
+# mirrored on both sides.
+#
+# Email: SRE@vonage.com
+
+import asyncio
+import hashlib
+import json
+import struct
+import time
+import uuid
+import websockets
+
+MUX_AGENT_VERSION = "3.1.1446.0"
+BASIC_AGENT_VERSION = "3.0.161.0"
+
+# Agent versions after this one multiplex the connections of a port session
+MUX_SUPPORTED_AFTER_AGENT_VERSION = (3, 0, 196, 0)
+
+INPUT_STREAM_DATA = "input_stream_data"
+OUTPUT_STREAM_DATA = "output_stream_data"
+ACKNOWLEDGE = "acknowledge"
+
+# Payload types
+OUTPUT = 1
+HANDSHAKE_REQUEST = 5
+HANDSHAKE_RESPONSE = 6
+HANDSHAKE_COMPLETE = 7
+FLAG = 10
+
+# Flags sent by the client
+DISCONNECT_TO_PORT = 1
+TERMINATE_SESSION = 2
+
+# Stream data payloads of the agent are at most this long
+STREAM_DATA_PAYLOAD_SIZE = 1024
+
+# smux v1 frame header: version, command, length, stream id (little endian)
+SMUX_HEADER = struct.Struct("<BBHI")
+SMUX_VERSION = 1
+SMUX_SYN = 0
+SMUX_FIN = 1
+SMUX_PSH = 2
+
+# Header length (up to the payload length), message type, schema version,
+# created date, sequence number, flags, message id, payload digest, payload type
+HEADER_LENGTH = 116
+MESSAGE_TYPE_LENGTH = 32
+
+
+class AgentMessage(object):
+
+    def __init__(self, message_type, payload=b"", payload_type=0, sequence_number=0,
+                 flags=0, message_id=None):
+        self.message_type = message_type
+        self.payload = payload
+        self.payload_type = payload_type
+        self.sequence_number = sequence_number
+        self.flags = flags
+        self.message_id = message_id or uuid.uuid4()
+
+    def serialize(self):
+        # The UUID is written least significant half first
+        message_id = self.message_id.bytes[8:] + self.message_id.bytes[:8]
+        return b"".join([
+            HEADER_LENGTH.to_bytes(4, "big"),
+            self.message_type.encode().ljust(MESSAGE_TYPE_LENGTH, b" "),
+            (1).to_bytes(4, "big"),
+            int(time.time() * 1000).to_bytes(8, "big"),
+            self.sequence_number.to_bytes(8, "big", signed=True),
+            self.flags.to_bytes(8, "big"),
+            message_id,
+            hashlib.sha256(self.payload).digest(),
+            self.payload_type.to_bytes(4, "big"),
+            len(self.payload).to_bytes(4, "big"),
+            self.payload,
+        ])
+
+    @classmethod
+    def deserialize(cls, data):
+        header_length = int.from_bytes(data[0:4], "big")
+        assert header_length == HEADER_LENGTH, f"Unexpected header length {header_length}"
+        message_type = data[4:36].rstrip(b" \x00").decode()
+        sequence_number = int.from_bytes(data[48:56], "big", signed=True)
+        flags = int.from_bytes(data[56:64], "big")
+        message_id = uuid.UUID(bytes=data[72:80] + data[64:72])
+        digest = data[80:112]
+        payload_type = int.from_bytes(data[112:116], "big")
+        payload_length = int.from_bytes(data[116:120], "big")
+        payload = data[120:120 + payload_length]
+        assert len(payload) == payload_length, "Truncated payload"
+        assert hashlib.sha256(payload).digest() == digest, "Payload digest mismatch"
+        return cls(message_type, payload, payload_type, sequence_number, flags, message_id)
+
+
+def supports_mux(agent_version):
+    return tuple(int(part) for part in agent_version.split(".")) > MUX_SUPPORTED_AFTER_AGENT_VERSION
+
+
+class FakeAgent(object):
+
+    # Parameters:
+    # agent_version - reported in the handshake, decides whether smux is used
+    # host - where the remote ports of the sessions are connected to
+    # drop_first_message - ignore the first stream data message of every
+    #                      session without acknowledging it, to exercise resends
+    def __init__(self, agent_version=MUX_AGENT_VERSION, host="127.0.0.1", drop_first_message=False):
+        self.agent_version = agent_version
+        self.host = host
+        self.drop_first_message = drop_first_message
+        self.sessions = {}
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await websockets.serve(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        self.server.close()
+
+    # Called by FakeFleet.StartSession
+    def start_session(self, remote_port):
+        session_id = f"benchmark-{uuid.uuid4().hex[:17]}"
+        self.sessions[session_id] = int(remote_port)
+        return {
+            "SessionId": session_id,
+            "TokenValue": f"token-{session_id}",
+            "StreamUrl": f"ws://127.0.0.1:{self.port}/{session_id}",
+        }
+
+    async def handle(self, websocket, path=None):
+        # The path argument and attribute are gone in newer websockets versions
+        path = path or getattr(websocket, "path", None) or websocket.request.path
+        remote_port = self.sessions[path.strip("/")]
+        open_data_channel = json.loads(await websocket.recv())
+        assert open_data_channel["TokenValue"].startswith("token-")
+        await AgentSession(self, websocket, remote_port).serve()
+
+
+class AgentSession(object):
+
+    def __init__(self, agent, websocket, remote_port):
+        self.agent = agent
+        self.websocket = websocket
+        self.remote_port = remote_port
+        self.mux = supports_mux(agent.agent_version)
+        self.sequence_number = 0
+        self.expected_sequence_number = 0
+        self.out_of_order = {}
+        self.dropped = not agent.drop_first_message
+        self.buffer = bytearray()
+        self.connections = {}
+        self.send_lock = asyncio.Lock()
+
+    async def send(self, payload_type, payload):
+        async with self.send_lock:
+            message = AgentMessage(OUTPUT_STREAM_DATA, payload, payload_type, self.sequence_number)
+            self.sequence_number += 1
+            await self.websocket.send(message.serialize())
+
+    async def serve(self):
+        await self.send(HANDSHAKE_REQUEST, json.dumps({
+            "AgentVersion": self.agent.agent_version,
+            "RequestedClientActions": [{
+                "ActionType": "SessionType",
+                "ActionParameters": {"SessionType": "Port",
+                                     "Properties": {"portNumber": str(self.remote_port)}},
+            }],
+        }).encode())
+        try:
+            async for data in self.websocket:
+                message = AgentMessage.deserialize(data)
+                if message.message_type != INPUT_STREAM_DATA:
+                    continue
+                if not self.dropped and message.payload_type == OUTPUT:
+                    self.dropped = True
+                    continue
+                await self.websocket.send(AgentMessage(ACKNOWLEDGE, json.dumps({
+                    "AcknowledgedMessageType": message.message_type,
+                    "AcknowledgedMessageId": str(message.message_id),
+                    "AcknowledgedMessageSequenceNumber": message.sequence_number,
+                    "IsSequentialMessage": True,
+                }).encode(), flags=3).serialize())
+                self.out_of_order[message.sequence_number] = message
+                while self.expected_sequence_number in self.out_of_order:
+                    await self.process(self.out_of_order.pop(self.expected_sequence_number))
+                    self.expected_sequence_number += 1
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            for reader, writer in self.connections.values():
+                writer.close()
+
+    async def process(self, message):
+        if message.payload_type == HANDSHAKE_RESPONSE:
+            await self.send(HANDSHAKE_COMPLETE, json.dumps(
+                {"HandshakeTimeToComplete": 0, "CustomerMessage": ""}).encode())
+        elif message.payload_type == FLAG:
+            flag, = struct.unpack(">I", message.payload)
+            if flag == TERMINATE_SESSION:
+                await self.websocket.close()
+            elif flag == DISCONNECT_TO_PORT and 0 in self.connections:
+                self.connections.pop(0)[1].close()
+        elif message.payload_type == OUTPUT:
+            if self.mux:
+                await self.demultiplex(message.payload)
+            else:
+                if 0 not in self.connections:
+                    await self.connect(0)
+                self.connections[0][1].write(message.payload)
+
+    async def demultiplex(self, data):
+        header = SMUX_HEADER
+        self.buffer += data
+        while len(self.buffer) >= header.size:
+            version, command, length, stream_id = header.unpack_from(self.buffer)
+            assert version == SMUX_VERSION, f"Unexpected smux version {version}"
+            if len(self.buffer) < header.size + length:
+                return
+            payload = bytes(self.buffer[header.size:header.size + length])
+            del self.buffer[:header.size + length]
+            if command == SMUX_SYN:
+                await self.connect(stream_id)
+            elif command == SMUX_PSH and stream_id in self.connections:
+                self.connections[stream_id][1].write(payload)
+            elif command == SMUX_FIN and stream_id in self.connections:
+                self.connections.pop(stream_id)[1].close()
+
+    async def connect(self, stream_id):
+        reader, writer = await asyncio.open_connection(self.agent.host, self.remote_port)
+        self.connections[stream_id] = (reader, writer)
+        asyncio.ensure_future(self.pump(stream_id, reader))
+
+    # Sends what the remote port writes back to the client
+    async def pump(self, stream_id, reader):
+        header = SMUX_HEADER
+        try:
+            while True:
+                data = await reader.read(STREAM_DATA_PAYLOAD_SIZE - header.size)
+                if not data:
+                    break
+                if self.mux:
+                    data = header.pack(SMUX_VERSION, SMUX_PSH, len(data), stream_id) + data
+                await self.send(OUTPUT, data)
+            if self.mux and self.connections.pop(stream_id, None):
+                await self.send(OUTPUT, header.pack(
+                    SMUX_VERSION, SMUX_FIN, 0, stream_id))
+        except websockets.exceptions.ConnectionClosed:
+            pass
@@ -0,0 +1,219 @@
+# Offline stand-in for the AWS APIs used by the toolkit
+#
+# FakeFleet answers SSM, EC2, STS and S3 object calls for a synthetic fleet of instances.
+# It is installed as the last botocore "before-call" handler of every boto3
+# Session: when such a handler returns a response, botocore skips signing and
+# sending the request, so no credentials or network access are needed and the
+# rest of the client stack (parameter validation, pagination, the toolkit's
+# own event hooks) still runs.
+#
+# Email: SRE@vonage.com
+
+import boto3
+import datetime
+import threading
+import time
+import uuid
+
+PAGE_SIZE = 50
+
+# Fleet answering the calls of all sessions, see FakeFleet.install
+_active_fleet = None
+
+
+class HTTPResponse(object):
+    status_code = 200
+    headers = {}
+
+
+# Raised by the handlers to answer with an error response
+class FakeError(Exception):
+
+    def __init__(self, code, status_code=400):
+        super(FakeError, self).__init__(code)
+        self.code = code
+        self.status_code = status_code
+
+
+class FakeFleet(object):
+
+    # Parameters:
+    # size - number of instances in the fleet
+    # latency - seconds every API call takes
+    # command_duration - seconds after which a sent command reports Success
+    def __init__(self, size, latency=0.0, command_duration=0.0):
+        self.latency = latency
+        self.command_duration = command_duration
+        self.instances = [self.make_instance(i) for i in range(size)]
+        self.by_id = {i["InstanceId"]: i for i in self.instances}
+        self.by_filter = {}
+        for instance in self.instances:
+            for name, value in [("tag:Name", instance["Tags"][0]["Value"]),
+                                ("private-ip-address", instance["PrivateIpAddress"]),
+                                ("ip-address", instance["PublicIpAddress"]),
+                                ("private-dns-name", instance["PrivateDnsName"])]:
+                self.by_filter.setdefault((name, value), []).append(instance)
+        self.commands = {}
+        # (Bucket, Key) -> Body of the objects put to S3
+        self.objects = {}
+        # benchmarks.fake_agent.FakeAgent serving the sessions, if any
+        self.agent = None
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_instance(i):
+        private_ip = f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"
+        return {
+            "InstanceId": f"i-{i:017x}",
+            "PrivateIpAddress": private_ip,
+            "PublicIpAddress": f"54.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+            "PrivateDnsName": f"ip-{private_ip.replace('.', '-')}.ec2.internal",
+            "Tags": [
+                {"Key": "Name", "Value": f"host-{i}"},
+                {"Key": "Role", "Value": ["web", "db", "cache", "worker"][i % 4]},
+            ],
+        }
+
+    # Makes every boto3 Session created from now on talk to this fleet
+    def install(self):
+        global _active_fleet
+        if _active_fleet is None:
+            original_init = boto3.Session.__init__
+
+            def init(session, *args, **kwargs):
+                original_init(session, *args, **kwargs)
+                session.events.register(
+                    "before-parameter-build", lambda **kwargs: _active_fleet.capture_params(**kwargs))
+                session.events.register_last(
+                    "before-call", lambda **kwargs: _active_fleet.handle(**kwargs))
+
+            boto3.Session.__init__ = init
+        _active_fleet = self
+        return self
+
+    # The serialized request seen by before-call is protocol specific, so the
+    # plain API parameters are kept in the request context
+    def capture_params(self, params, context, **kwargs):
+        context["fake_aws_params"] = dict(params)
+
+    def handle(self, model, context, **kwargs):
+        with self.lock:
+            self.calls[model.name] = self.calls.get(model.name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, model.name)
+        http_response = HTTPResponse()
+        try:
+            response = handler(context["fake_aws_params"])
+        except FakeError as e:
+            http_response.status_code = e.status_code
+            response = {"Error": {"Code": e.code, "Message": e.code}}
+        response["ResponseMetadata"] = {"HTTPStatusCode": http_response.status_code}
+        return http_response, response
+
+    @staticmethod
+    def page(items, params, key):
+        start = int(params.get("NextToken") or 0)
+        response = {key: items[start:start + PAGE_SIZE]}
+        if start + PAGE_SIZE < len(items):
+            response["NextToken"] = str(start + PAGE_SIZE)
+        return response
+
+    def DescribeInstanceInformation(self, params):
+        return self.page([{
+            "InstanceId": i["InstanceId"],
+            "ResourceType": "EC2Instance",
+            "PingStatus": "Online",
+            "ComputerName": i["PrivateDnsName"],
+        } for i in self.instances], params, "InstanceInformationList")
+
+    def DescribeInstances(self, params):
+        if params.get("InstanceIds"):
+            instances = [self.by_id[i] for i in params["InstanceIds"] if i in self.by_id]
+        else:
+            instances = self.instances
+        for f in params.get("Filters", []):
+            if "Name" not in f:
+                continue
+            matches = set()
+            for value in f["Values"]:
+                matches.update(i["InstanceId"] for i in self.by_filter.get((f["Name"], value), []))
+            instances = [i for i in instances if i["InstanceId"] in matches]
+        return {"Reservations": [{"Instances": instances}]}
+
+    def SendCommand(self, params):
+        command_id = str(uuid.uuid4())
+        instance_ids = params.get("InstanceIds") or [i["InstanceId"] for i in self.instances]
+        for target in params.get("Targets", []):
+            if target["Key"] == "InstanceIds":
+                instance_ids = [i for i in instance_ids if i in target["Values"]]
+            elif target["Key"].startswith("tag:"):
+                key = target["Key"][4:]
+                instance_ids = [i for i in instance_ids if any(
+                    tag["Key"] == key and tag["Value"] in target["Values"]
+                    for tag in self.by_id[i]["Tags"])]
+        self.commands[command_id] = (time.time(), instance_ids)
+        return {"Command": {"CommandId": command_id}}
+
+    def ListCommands(self, params):
+        sent, instance_ids = self.commands[params["CommandId"]]
+        done = time.time() - sent >= self.command_duration
+        return {"Commands": [{
+            "CommandId": params["CommandId"],
+            "Status": "Success" if done else "InProgress",
+            "TargetCount": len(instance_ids),
+            "CompletedCount": len(instance_ids) if done else 0,
+        }]}
+
+    def ListCommandInvocations(self, params):
+        sent, instance_ids = self.commands[params["CommandId"]]
+        if params.get("InstanceId"):
+            instance_ids = [params["InstanceId"]]
+        status = "Success" if time.time() - sent >= self.command_duration else "InProgress"
+        return self.page([{
+            "CommandId": params["CommandId"],
+            "InstanceId": instance_id,
+            "Status": status,
+            "CommandPlugins": [{"Name": "aws:runShellScript", "Output": f"ok {instance_id}\n"}],
+        } for instance_id in instance_ids], params, "CommandInvocations")
+
+    def StartSession(self, params):
+        return self.agent.start_session(params["Parameters"]["portNumber"][0])
+
+    def TerminateSession(self, params):
+        return {"SessionId": params["SessionId"]}
+
+    def HeadObject(self, params):
+        body = self.objects.get((params["Bucket"], params["Key"]))
+        if body is None:
+            raise FakeError("404", 404)
+        return {"ContentLength": len(body)}
+
+    def PutObject(self, params):
+        body = params["Body"]
+        self.objects[(params["Bucket"], params["Key"])] = body if isinstance(body, bytes) else body.read()
+        return {"ETag": f'"{uuid.uuid4().hex}"'}
+
+    def AssumeRole(self, params):
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            seconds=params.get("DurationSeconds") or 3600)
+        return {
+            "Credentials": {
+                "AccessKeyId": f"ASIA{uuid.uuid4().hex[:16].upper()}",
+                "SecretAccessKey": uuid.uuid4().hex,
+                "SessionToken": uuid.uuid4().hex,
+                "Expiration": expiration,
+            },
+            "AssumedRoleUser": {
+                "AssumedRoleId": f"AROAEXAMPLE:{params['RoleSessionName']}",
+                "Arn": f"{params['RoleArn']}/{params['RoleSessionName']}",
+            },
+        }
+
+    def GetCallerIdentity(self, params):
+        return {
+            "UserId": "AIDAEXAMPLE",
+            "Account": "123456789012",
+            "Arn": "arn:aws:sts::123456789012:assumed-role/Benchmark/benchmark-user",
+        }
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+# Offline benchmarks for the toolkit entry points
+#
+# Runs ssm-list, instance resolution and ssm-run against benchmarks.fake_aws
+# for synthetic fleets of different sizes, measures CLI startup time and, when
+# websockets is installed, native tunnel setup against benchmarks.fake_agent,
+# and writes the results as JSON so that they can be compared between releases.
+#
+#   python -m benchmarks.run_benchmarks --output results.json
+#   python -m benchmarks.run_benchmarks --compare results-0.0.7.json
+#
+# Email: SRE@vonage.com
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ENTRY_POINTS = ["ssm_connect", "ssm_list", "ssm_port_forward", "ssm_run", "ssm_ssh"]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for aws-systems-manager-toolkit")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="Fleet sizes to benchmark")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Simulated seconds per API call")
+    parser.add_argument("--command-duration", type=float, default=0.0,
+                        help="Simulated seconds before a command finishes")
+    parser.add_argument("--resolves", type=int, default=50,
+                        help="Number of get_instance calls per fleet size")
+    parser.add_argument("--startup-runs", type=int, default=5,
+                        help="Number of runs per entry point for the startup time")
+    parser.add_argument("--no-rate-limit", dest="rate_limit", action="store_false",
+                        help="Disable the client-side rate limits, which are enabled by default as in the tools")
+    parser.add_argument("--output", "-o", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare the results with a previous JSON file")
+    return parser.parse_args(argv)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def summary(values):
+    return {
+        "mean": statistics.mean(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "max": max(values),
+    }
+
+
+def bench_ssm_list(ssm_list):
+    ssm_list.args = argparse.Namespace(filters=None, profile=None, region=None,
+                                       profiles=None, external_sort=False)
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            ssm_list.print_list()
+
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": elapsed, "peak_memory_bytes": peak}
+
+
+def bench_get_instance(common, fleet, count):
+    targets = [random.choice(fleet.instances)["Tags"][0]["Value"] for _ in range(count)]
+    latencies = []
+    for target in targets:
+        start = time.perf_counter()
+        common.get_instance(target)
+        latencies.append(time.perf_counter() - start)
+    return summary(latencies)
+
+
+def bench_ssm_run(ssm_run, fleet):
+    targets = [i["InstanceId"] for i in fleet.instances]
+    first_result = []
+    print_output = ssm_run.print_output
+
+    def record_first_result(run, instance_ids):
+        if not first_result:
+            first_result.append(time.perf_counter())
+        print_output(run, instance_ids)
+
+    ssm_run.print_output = record_first_result
+    sys.argv = ["ssm-run", *targets, "--commands", "uptime"]
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            ssm_run.main()
+    finally:
+        ssm_run.print_output = print_output
+    completion = time.perf_counter() - start
+    return {
+        "first_result_seconds": first_result[0] - start if first_result else None,
+        "completion_seconds": completion,
+    }
+
+
+# Native port forwarding through benchmarks.fake_agent to a local echo server:
+# time until the local port listens, and echo round trip latency
+def bench_tunnel(fleet, round_trips=20):
+    from benchmarks.fake_agent import FakeAgent
+    from toolkit import aio, common, datachannel
+
+    async def echo(reader, writer):
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+        writer.close()
+
+    async def start_remote():
+        return (await asyncio.start_server(echo, "127.0.0.1", 0)), (await FakeAgent().start())
+
+    # The agent and the remote port live on their own loop, like remote hosts
+    loop = asyncio.new_event_loop()
+    echo_server, fleet.agent = loop.run_until_complete(start_remote())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    async def run():
+        ssm = common.get_session().client("ssm")
+        session = datachannel.PortForwardSession(
+            ssm, fleet.instances[0]["InstanceId"], echo_server.sockets[0].getsockname()[1], 0)
+        start = time.perf_counter()
+        await session.start()
+        setup = time.perf_counter() - start
+        reader, writer = await asyncio.open_connection(
+            "127.0.0.1", session.server.sockets[0].getsockname()[1])
+        latencies = []
+        for _ in range(round_trips):
+            start = time.perf_counter()
+            writer.write(b"ping")
+            await reader.readexactly(4)
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+        session.server.close()
+        session.port.close()
+        await session.channel.close()
+        session.terminate()
+        return {"setup_seconds": setup, "round_trip": summary(latencies)}
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return aio.run(run())
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        fleet.agent = None
+
+
+def bench_startup(runs):
+    results = {}
+    for module in ENTRY_POINTS:
+        durations = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-m", f"toolkit.{module}", "--help"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            durations.append(time.perf_counter() - start)
+        results[module] = summary(durations)
+    return results
+
+
+def run_benchmarks(args):
+    from benchmarks.fake_aws import FakeFleet
+    from toolkit import common, datachannel, ssm_list, ssm_run
+
+    results = {}
+    for size in args.sizes:
+        fleet = FakeFleet(size, latency=args.latency, command_duration=args.command_duration).install()
+        results[str(size)] = {
+            "ssm_list": bench_ssm_list(ssm_list),
+            "get_instance": bench_get_instance(common, fleet, args.resolves),
+            "ssm_run": bench_ssm_run(ssm_run, fleet),
+            "api_calls": dict(fleet.calls),
+        }
+        if datachannel.is_available():
+            results[str(size)]["tunnel"] = bench_tunnel(fleet)
+        print(f"fleet {size}: {json.dumps(results[str(size)], default=str)}", file=sys.stderr)
+    return results
+
+
+# Prints the ratio new / old of every timing found in both result sets
+def compare(old, new, path=()):
+    for key, value in new.items():
+        if key == "parameters":
+            continue
+        if isinstance(value, dict):
+            compare(old.get(key, {}), value, path + (key,))
+        elif isinstance(value, (int, float)) and isinstance(old.get(key), (int, float)) and old[key]:
+            print(f"{'.'.join(path + (key,)):60} {old[key]:12.4f} {value:12.4f} {value / old[key]:8.2f}x")
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    # Keep the caches and run journal written by the tools out of the real home
+    # directory, and make sure no real credentials are ever picked up
+    home = tempfile.mkdtemp(prefix="ssm-toolkit-bench-")
+    os.environ.update({
+        "HOME": home,
+        "USERPROFILE": home,
+        "AWS_CONFIG_FILE": os.path.join(home, "config"),
+        "AWS_SHARED_CREDENTIALS_FILE": os.path.join(home, "credentials"),
+        "AWS_ACCESS_KEY_ID": "AKIDEXAMPLE",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "AWS_DEFAULT_REGION": "us-east-1",
+    })
+    if not args.rate_limit:
+        os.environ["SSM_TOOLKIT_RATE_LIMIT"] = "0"
+
+    import toolkit
+    report = {
+        "version": toolkit.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": datetime.datetime.now().isoformat(),
+        "parameters": vars(args),
+        "rate_limit": os.environ.get("SSM_TOOLKIT_RATE_LIMIT", "1") != "0",
+        "startup": bench_startup(args.startup_runs),
+        "fleets": run_benchmarks(args),
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -48,8 +48,12 @@ setup(
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8'
     ],
-    packages=find_namespace_packages(exclude=("docs",)),
+    packages=find_namespace_packages(exclude=("docs", "benchmarks", "benchmarks.*", "tests", "tests.*")),
     install_requires=["boto3", "botocore"],
+    extras_require={
+        # Native Session Manager client for ssm-port-forward --native
+        "native": ["websockets"],
+    },
     entry_points={
         "console_scripts": [
             "ssm-connect=toolkit.ssm_connect:main",
@@ -57,6 +61,7 @@ setup(
             "ssm-port-forward=toolkit.ssm_port_forward:main",
             "ssm-run=toolkit.ssm_run:main",
             "ssm-ssh=toolkit.ssm_ssh:main",
+            "ssm-toolkitd=toolkit.ssm_toolkitd:main",
         ]
     },
 )
\ No newline at end of file
@@ -0,0 +1,236 @@
+# Tests of the native Session Manager client (toolkit.datachannel)
+#
+# The framing is checked against byte vectors written out from the layout of
+# the session-manager-plugin, and port sessions run end to end against the
+# agent stand-in of benchmarks.fake_agent, which frames its messages itself.
+#
+# Run with: python -m pytest tests
+#
+# Email: SRE@vonage.com
+
+import asyncio
+import unittest
+import uuid
+from toolkit import datachannel
+from toolkit import ports
+from toolkit.datachannel import ClientMessage
+
+if datachannel.is_available():
+    from benchmarks import fake_agent
+
+MESSAGE_ID = uuid.UUID("00112233-4455-6677-8899-aabbccddeeff")
+
+# input_stream_data message with payload b"hello" of type Output, sequence
+# number 5, flags 3, created at 1600000000000 ms
+HELLO_MESSAGE = bytes.fromhex(
+    "00000074"                                                          # header length
+    "696e7075745f73747265616d5f64617461202020202020202020202020202020"  # message type
+    "00000001"                                                          # schema version
+    "00000174876e8000"                                                  # created date
+    "0000000000000005"                                                  # sequence number
+    "0000000000000003"                                                  # flags
+    "8899aabbccddeeff0011223344556677"                                  # message id
+    "2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824"  # sha256(payload)
+    "00000001"                                                          # payload type
+    "00000005"                                                          # payload length
+) + b"hello"
+
+
+class ClientMessageTest(unittest.TestCase):
+
+    def test_serialize(self):
+        message = ClientMessage(datachannel.INPUT_STREAM_DATA, b"hello", datachannel.OUTPUT,
+                                sequence_number=5, flags=3, message_id=MESSAGE_ID,
+                                created_date=1600000000000)
+        self.assertEqual(message.serialize(), HELLO_MESSAGE)
+
+    def test_deserialize(self):
+        message = ClientMessage.deserialize(HELLO_MESSAGE)
+        self.assertEqual(message.message_type, datachannel.INPUT_STREAM_DATA)
+        self.assertEqual(message.payload, b"hello")
+        self.assertEqual(message.payload_type, datachannel.OUTPUT)
+        self.assertEqual(message.sequence_number, 5)
+        self.assertEqual(message.flags, 3)
+        self.assertEqual(message.message_id, MESSAGE_ID)
+        self.assertEqual(message.created_date, 1600000000000)
+
+    def test_deserialize_rejects_bad_digest(self):
+        with self.assertRaises(ValueError):
+            ClientMessage.deserialize(HELLO_MESSAGE[:-5] + b"jello")
+
+    def test_deserialize_rejects_truncated_message(self):
+        with self.assertRaises(ValueError):
+            ClientMessage.deserialize(HELLO_MESSAGE[:-1])
+        with self.assertRaises(ValueError):
+            ClientMessage.deserialize(HELLO_MESSAGE[:100])
+
+    def test_supports_mux(self):
+        self.assertTrue(datachannel.supports_mux("3.0.222.0"))
+        self.assertTrue(datachannel.supports_mux("3.1.1446.0"))
+        self.assertFalse(datachannel.supports_mux("3.0.196.0"))
+        self.assertFalse(datachannel.supports_mux("2.3.68.0"))
+        self.assertFalse(datachannel.supports_mux(None))
+
+
+# Collects what a port sends through the data channel
+class RecordingChannel(object):
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_data(self, data):
+        self.sent.append(data)
+
+
+class RecordingWriter(object):
+
+    def __init__(self):
+        self.data = b""
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class SmuxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.channel = RecordingChannel()
+        self.port = datachannel.MuxPort(self.channel)
+
+    def tearDown(self):
+        self.port.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_frames(self):
+        run = self.loop.run_until_complete
+        run(self.port.send_frame(datachannel.SMUX_SYN, 1))
+        run(self.port.send_frame(datachannel.SMUX_PSH, 1, b"abc"))
+        run(self.port.send_frame(datachannel.SMUX_FIN, 0x01020304))
+        run(self.port.send_frame(datachannel.SMUX_NOP, 0))
+        self.assertEqual(self.channel.sent, [
+            bytes.fromhex("0100000001000000"),
+            bytes.fromhex("0102030001000000") + b"abc",
+            bytes.fromhex("0101000004030201"),
+            bytes.fromhex("0103000000000000"),
+        ])
+
+    def test_output_split_across_messages(self):
+        writer = RecordingWriter()
+        self.port.streams[3] = writer
+        data = (bytes.fromhex("0102050003000000") + b"hello"
+                + bytes.fromhex("0102020005000000") + b"xx"      # unknown stream
+                + bytes.fromhex("0101000003000000"))
+        for i in range(0, len(data), 3):
+            self.loop.run_until_complete(self.port.on_output(data[i:i + 3]))
+        self.assertEqual(writer.data, b"hello")
+        self.assertTrue(writer.closed)
+        self.assertNotIn(3, self.port.streams)
+        self.assertEqual(self.port.buffer, b"")
+
+
+class FakeSSM(object):
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.terminated = []
+
+    def start_session(self, Target, DocumentName, Parameters):
+        return self.agent.start_session(Parameters["portNumber"][0])
+
+    def terminate_session(self, SessionId):
+        self.terminated.append(SessionId)
+        return {"SessionId": SessionId}
+
+
+async def echo(reader, writer):
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+@unittest.skipUnless(datachannel.is_available(), "websockets is not installed")
+class PortForwardSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    # Forwards connections through a session with agent to an echo server and
+    # checks that every connection gets its own data back
+    def forward(self, agent, connections, size):
+        async def run():
+            server = await asyncio.start_server(echo, "127.0.0.1", 0)
+            await agent.start()
+            ssm = FakeSSM(agent)
+            sock = ports.bind()
+            session = datachannel.PortForwardSession(
+                ssm, "i-00000000000000001", server.sockets[0].getsockname()[1], sock=sock)
+            serving = asyncio.ensure_future(session.serve())
+            try:
+                while not hasattr(session, "server"):
+                    await asyncio.sleep(0.01)
+                local_port = sock.getsockname()[1]
+
+                async def connect(i):
+                    reader, writer = await asyncio.open_connection("127.0.0.1", local_port)
+                    data = bytes([i]) * size
+                    writer.write(data)
+                    received = await reader.readexactly(len(data))
+                    writer.close()
+                    return received == data
+
+                if agent.agent_version == fake_agent.BASIC_AGENT_VERSION:
+                    # One connection at a time
+                    results = [await connect(i) for i in range(connections)]
+                else:
+                    results = await asyncio.gather(*[connect(i) for i in range(connections)])
+                return results
+            finally:
+                serving.cancel()
+                try:
+                    await serving
+                except asyncio.CancelledError:
+                    pass
+                session.terminate()
+                agent.stop()
+                await agent.server.wait_closed()
+                server.close()
+                await server.wait_closed()
+
+        results = self.loop.run_until_complete(asyncio.wait_for(run(), 30))
+        self.assertEqual(results, [True] * connections)
+
+    def test_mux_port(self):
+        self.forward(fake_agent.FakeAgent(fake_agent.MUX_AGENT_VERSION), 5, 100000)
+
+    def test_basic_port(self):
+        self.forward(fake_agent.FakeAgent(fake_agent.BASIC_AGENT_VERSION), 3, 20000)
+
+    def test_resend_after_dropped_message(self):
+        self.forward(fake_agent.FakeAgent(drop_first_message=True), 1, 3000)
+
+    def test_basic_port_resend_after_dropped_message(self):
+        self.forward(fake_agent.FakeAgent(fake_agent.BASIC_AGENT_VERSION, drop_first_message=True), 1, 3000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+# Asyncio core used by the SSM tools
+#
+# botocore is synchronous, so every API call is offloaded to one bounded thread
+# pool shared by the whole process.  Coroutines built on top of call() and
+# paginate() can keep hundreds of paginations and command waits in flight on a
+# single event loop without starting a thread per request.
+#
+# Email: SRE@vonage.com
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+
+__all__ = []
+
+
+logger = logging.getLogger()
+
+# Upper bound of botocore calls running at the same time
+MAX_WORKERS = 32
+
+# Seconds between two list_command_invocations polls
+POLL_INTERVAL = 1
+
+# Invocation statuses after which SSM will not update the invocation any more
+FINAL_STATUSES = ["Success", "Failed", "Cancelled", "TimedOut",
+                  "Undeliverable", "Terminated"]
+
+# Command statuses after which SSM will not start any more invocations
+FINAL_COMMAND_STATUSES = ["Success", "Failed", "Cancelled", "TimedOut"]
+
+_executor = None
+_DONE = object()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_WORKERS)
+    return _executor
+
+
+__all__.append("run")
+
+
+# Runs a coroutine to completion on a fresh event loop and returns its result.
+# Used by the synchronous entry points and helpers in toolkit.common.  Tasks
+# still pending when it returns, or when a signal handler interrupted it, are
+# cancelled so that their cleanup runs before the loop is closed.
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        try:
+            cancel_tasks(loop)
+        finally:
+            loop.close()
+
+
+def cancel_tasks(loop):
+    all_tasks = getattr(asyncio, "all_tasks", None) or asyncio.Task.all_tasks
+    tasks = [task for task in all_tasks(loop) if not task.done()]
+    if not tasks:
+        return
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
+__all__.append("call")
+
+
+# Parameters:
+# func - blocking callable, usually a boto3 client method
+# args, kwargs - passed through to func
+#
+# Returns:
+# The return value of func, computed on the shared thread pool
+async def call(func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(func, *args, **kwargs))
+
+
+__all__.append("paginate")
+
+
+# Asynchronous version of client.get_paginator(operation).paginate(**kwargs).
+# Each page is fetched on the shared thread pool so other coroutines keep
+# running while the request is on the wire.
+async def paginate(client, operation, **kwargs):
+    pages = iter(client.get_paginator(operation).paginate(**kwargs))
+    while True:
+        page = await call(next, pages, _DONE)
+        if page is _DONE:
+            return
+        yield page
+
+
+__all__.append("chunks")
+
+
+def chunks(items, size):
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+__all__.append("list_command_invocations")
+
+
+async def list_command_invocations(ssm, command_id, instance_id=None):
+    kwargs = {"CommandId": command_id, "Details": True}
+    if instance_id:
+        kwargs["InstanceId"] = instance_id
+    invocations = []
+    async for page in paginate(ssm, "list_command_invocations", **kwargs):
+        invocations.extend(page["CommandInvocations"])
+    return invocations
+
+
+__all__.append("wait_for_invocations")
+
+
+# Parameters:
+# ssm - SSM Boto3 Client
+# command_id - CommandId to wait for
+# instance_id - only wait for the invocation on this instance
+# expected - number of invocations the command is known to have, if any
+#
+# Returns:
+# The list of CommandInvocations once every one of them reached a final status
+async def wait_for_invocations(ssm, command_id, instance_id=None, expected=None):
+    while True:
+        invocations = await list_command_invocations(ssm, command_id, instance_id)
+        done = [ci for ci in invocations if ci["Status"] in FINAL_STATUSES]
+        if invocations and len(done) == len(invocations) and len(done) >= (expected or 0):
+            return invocations
+        logger.debug("Command %s: %d of %d invocations finished",
+                     command_id, len(done), expected or len(invocations))
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+__all__.append("wait_for_targets")
+
+
+# Waits for a command sent with Targets instead of InstanceIds.  The instances
+# are only known once SSM has expanded the targets, so the command status is
+# polled instead of the invocations.
+#
+# Returns:
+# The list of CommandInvocations once the command reached a final status
+async def wait_for_targets(ssm, command_id):
+    while True:
+        response = await call(ssm.list_commands, CommandId=command_id)
+        command = response["Commands"][0]
+        if command["Status"] in FINAL_COMMAND_STATUSES:
+            return await list_command_invocations(ssm, command_id)
+        logger.debug("Command %s: %d of %d targets finished", command_id,
+                     command.get("CompletedCount", 0), command.get("TargetCount", 0))
+        await asyncio.sleep(POLL_INTERVAL)
@@ -3,10 +3,23 @@
 #
 # Email: SRE@vonage.com
 
+import asyncio
 import boto3
+import hashlib
+import json
+from botocore.config import Config
 import logging
+import os
 import re
+import tempfile
 import time
+from . import aio
+from . import credentials
+from . import fuzzy
+from . import ratelimit
+from . import timings
+from . import toolkitd
+from .filelock import file_lock
 
 __all__ = []
 
@@ -26,42 +39,170 @@ def format_filters(target):
         return [{'Name': 'tag:Name', 'Values': [target]}]
 
 
+__all__.append("get_session")
+
+
+# All boto3 sessions used by the tools are built here so that every client
+# shares the same defaults, e.g. a connection pool large enough for the
+# concurrent calls issued by toolkit.aio, the client-side rate limits of
+# toolkit.ratelimit and the credential cache of toolkit.credentials
+def get_session(profile=None, region=None):
+    with timings.phase("session", profile=profile, region=region):
+        session = boto3.Session(profile_name=profile, region_name=region)
+    session._session.set_default_client_config(
+        Config(max_pool_connections=aio.MAX_WORKERS))
+    timings.register(session)
+    if os.environ.get("SSM_TOOLKIT_CREDENTIAL_CACHE", "1") != "0":
+        cache = credentials.SharedFileCache()
+        if credentials.register(session, cache):
+            credentials.lock_refreshes(session, cache)
+    if os.environ.get("SSM_TOOLKIT_RATE_LIMIT", "1") != "0":
+        state_file = None
+        if os.environ.get("SSM_TOOLKIT_SHARED_RATE_LIMIT") == "1":
+            state_file = os.path.join(get_toolkit_dir(), "ratelimit.json")
+        ratelimit.register(session, state_file)
+    return session
+
+
+__all__.append("resolve_instance")
+
+
+# Parameters:
+# ec2 - EC2 Boto3 Client
+# target - Name tag, host name or IP address to resolve
+#
+# Returns:
+# List of all instance ids matching the target
+async def resolve_instance(ec2, target):
+    instance_ids = []
+    filters = format_filters(target)
+    logger.debug(f"EC2 describe-instance filters: {filters}")
+    async for reservations in aio.paginate(ec2, 'describe_instances', Filters=filters):
+        for reservation in reservations['Reservations']:
+            for instance in reservation['Instances']:
+                instance_id = instance['InstanceId']
+                if instance_id not in instance_ids:
+                    instance_ids.append(instance_id)
+    return instance_ids
+
+
+def select_instance(target, instance_ids):
+    if not instance_ids:
+        logger.warning(f"No instance-id found for destination {target}")
+        return None
+
+    if len(instance_ids) > 1:
+        logger.warning("Found %d instances for '%s': %s", len(
+            instance_ids), target, " ".join(instance_ids))
+        logger.warning("Use INSTANCE_ID to connect to a specific one")
+        quit(1)
+
+    # Found only one instance - return it
+    return instance_ids[0]
+
+
+__all__.append("choose_instance")
+
+
+# Same as select_instance, but when interactive and running on a terminal an
+# ambiguous or unknown target is offered to the user in a fuzzy picker
+def choose_instance(target, instance_ids, profile=None, region=None, interactive=False):
+    if interactive and len(instance_ids) != 1 and fuzzy.can_prompt():
+        instance_id = fuzzy.pick_instance(target, instance_ids, profile, region)
+        if instance_id is None:
+            logger.warning(f"No instance selected for destination {target}")
+        return instance_id
+    return select_instance(target, instance_ids)
+
+
 __all__.append("get_instance")
 
 
-def get_instance(target, profile=None, region=None):
+def get_instance(target, profile=None, region=None, interactive=False):
     # Is it a valid Instance ID?
     if re.match('^i-[a-f0-9]+$', target):
         return target
     else:
         # Create boto3 client from session
-        session = boto3.Session(profile_name=profile, region_name=region)
-        ec2_client = session.client('ec2')
-
-        instance_ids = []
-        filters = format_filters(target)
-        logger.debug(f"EC2 describe-instance filters: {filters}")
-        paginator = ec2_client.get_paginator('describe_instances')
-        response_iterator = paginator.paginate(Filters=filters)
-        for reservations in response_iterator:
-            for reservation in reservations['Reservations']:
-                for instance in reservation['Instances']:
-                    instance_id = instance['InstanceId']
-                    if instance_id not in instance_ids:
-                        instance_ids.append(instance_id)
-
-        if not instance_ids:
-            logger.warning(f"No instance-id found for destination {target}")
-            return None
-
-        if len(instance_ids) > 1:
-            logger.warning("Found %d instances for '%s': %s", len(
-                instance_ids), target, " ".join(instance_ids))
-            logger.warning("Use INSTANCE_ID to connect to a specific one")
-            quit(1)
-
-        # Found only one instance - return it
-        return instance_ids[0]
+        with timings.phase("resolve", target=target):
+            instance_ids = toolkitd.resolve(target, profile, region)
+            if instance_ids is None:
+                session = get_session(profile, region)
+                ec2_client = session.client('ec2')
+                instance_ids = aio.run(resolve_instance(ec2_client, target))
+        return choose_instance(target, instance_ids, profile, region, interactive)
+
+
+__all__.append("resolve_instances")
+
+
+# Resolves all targets concurrently with one EC2 client.
+#
+# Returns:
+# Dict of target -> list of the instance ids matching it
+async def resolve_instances(targets, session):
+    ec2_client = session.client('ec2')
+
+    async def resolve(target):
+        if re.match('^i-[a-f0-9]+$', target):
+            return [target]
+        instance_ids = await aio.call(toolkitd.resolve, target, session.profile_name, session.region_name)
+        if instance_ids is not None:
+            return instance_ids
+        return await resolve_instance(ec2_client, target)
+
+    results = await asyncio.gather(*[resolve(target) for target in targets])
+    return dict(zip(targets, results))
+
+
+__all__.append("get_instances")
+
+
+# Returns:
+# Dict of instance id -> target, targets that could not be resolved are left out
+async def get_instances(targets, session):
+    instances = {}
+    for target, instance_ids in (await resolve_instances(targets, session)).items():
+        instance_id = select_instance(target, instance_ids)
+        if instance_id:
+            instances[instance_id] = target
+    return instances
+
+
+# Seconds a cached caller identity is used for when the credentials do not expire
+IDENTITY_TTL = 60 * 60
+
+
+__all__.append("get_caller_identity")
+
+
+# STS get_caller_identity, cached per profile in ~/.ssm_toolkit/identity.json.
+# A cached identity is only used with the same credentials it was fetched with
+# and never past their expiry.
+async def get_caller_identity(session):
+    credentials = await aio.call(session.get_credentials)
+    access_key = credentials.access_key if credentials else ""
+    fingerprint = hashlib.sha256(access_key.encode()).hexdigest()
+    identity_file = os.path.join(get_toolkit_dir(), "identity.json")
+
+    cached = read_json(identity_file, {}).get(session.profile_name)
+    if cached and cached["Credentials"] == fingerprint and cached["Expires"] > time.time():
+        return cached["Identity"]
+
+    sts = session.client('sts')
+    identity = await aio.call(sts.get_caller_identity)
+    identity.pop("ResponseMetadata", None)
+
+    expires = time.time() + IDENTITY_TTL
+    expiry_time = getattr(credentials, "_expiry_time", None)
+    if expiry_time:
+        expires = min(expires, expiry_time.timestamp())
+    with file_lock(f"{identity_file}.lock"):
+        identities = read_json(identity_file, {})
+        identities[session.profile_name] = {
+            "Identity": identity, "Credentials": fingerprint, "Expires": expires}
+        write_json(identity_file, identities)
+    return identity
 
 
 __all__.append("add_general_parameters")
@@ -75,6 +216,7 @@ def add_general_parameters(parser):
                          help='Configuration profile from ~/.aws/{credentials,config}')
     general.add_argument('--region', '-g', dest='region',
                          type=str, help='Set / override AWS region.')
+    timings.add_timing_parameters(general)
 
     return general
 
@@ -90,24 +232,59 @@ __all__.append("wait_for_command")
 # Returns:
 # True or False for pass and fail, respsectively
 def wait_for_command(ssm, command_id, instance_id):
-    status = get_status(ssm, command_id, instance_id)
-    while len(status['CommandInvocations']) == 0 or status['CommandInvocations'][0]['Status'] not in ["Success", "Failed"]:
-        time.sleep(1)
-        status = get_status(ssm, command_id, instance_id)
-        if status['CommandInvocations'][0]['Status'] == "Failed":
-            return False
-        elif status['CommandInvocations'][0]['Status'] == "Success":
-            return True
-
-
-def get_status(ssm, command_id, instance_id):
-    return ssm.list_command_invocations(
-        CommandId=command_id, InstanceId=instance_id, Details=True)
+    with timings.phase("wait_for_command", command_id=command_id):
+        invocations = aio.run(aio.wait_for_invocations(
+            ssm, command_id, instance_id=instance_id, expected=1))
+    return invocations[0]['Status'] == "Success"
 
 
 __all__.append("get_region")
 
 
+# Region of the default profile, read from the configuration without
+# resolving any credentials
 def get_region():
-    session = boto3.session.Session()
-    return session.region_name
+    return boto3.Session().region_name
+
+
+__all__.append("get_toolkit_dir")
+
+
+# Directory for state kept between runs (run journal, caches, ...), created on
+# demand.  The journal keeps the output of the commands, which may contain
+# secrets, so the directory is only accessible by the user.
+def get_toolkit_dir(*parts):
+    base = os.path.join(os.path.expanduser('~'), '.ssm_toolkit')
+    os.makedirs(base, mode=0o700, exist_ok=True)
+    if os.stat(base).st_mode & 0o077:
+        os.chmod(base, 0o700)
+    path = os.path.join(base, *parts)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+__all__.append("read_json")
+
+
+def read_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+__all__.append("write_json")
+
+
+# Writes to a temporary file first so that concurrent readers never see a
+# partially written file.  mkstemp creates the file with mode 0600.
+def write_json(path, data):
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2, default=str)
+        os.replace(tmp_file, path)
+    except (OSError, TypeError, ValueError):
+        os.unlink(tmp_file)
+        raise
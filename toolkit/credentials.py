@@ -0,0 +1,120 @@
+# Credential cache shared by all the toolkit processes and the AWS CLI
+#
+# The temporary credentials of profiles assuming a role (role_arn, including
+# role chains through source_profile, and web identity) are cached in
+# ~/.aws/cli/cache, in the same format and under the same keys as the AWS CLI,
+# so a role assumed (and an MFA code entered) once by either of them is reused
+# by every later process until the credentials are about to expire.  botocore
+# refreshes them from the cache, or with a new AssumeRole call, 15 minutes
+# before they expire.
+#
+# Writes are atomic, and the first process missing the cache assumes the role
+# while holding a file lock of the profile, so concurrent processes using the
+# same profile wait for it and reuse its credentials instead of each calling
+# STS (and asking for an MFA code).  Other profiles are not held up.  The role
+# is only assumed once an API call needs the credentials.
+#
+# Email: SRE@vonage.com
+
+import contextlib
+import hashlib
+import logging
+import os
+import tempfile
+from botocore.credentials import JSONFileCache, RefreshableCredentials
+from botocore.exceptions import BotoCoreError
+from . import timings
+from .filelock import file_lock
+
+__all__ = []
+
+logger = logging.getLogger()
+
+CLI_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.aws', 'cli', 'cache')
+
+# Credential providers of botocore that cache what they fetch
+CACHED_PROVIDERS = ["assume-role", "assume-role-with-web-identity"]
+
+# Profile settings that make botocore use one of CACHED_PROVIDERS
+ROLE_SETTINGS = ["role_arn", "web_identity_token_file"]
+
+
+__all__.append("SharedFileCache")
+
+
+class SharedFileCache(JSONFileCache):
+
+    def __init__(self, working_dir=CLI_CACHE_DIR):
+        super(SharedFileCache, self).__init__(working_dir)
+
+    # Parameters:
+    # name - "write" for the writes of cache entries, "fetch-..." for the
+    #        processes assuming a role, which write entries while holding it
+    @contextlib.contextmanager
+    def lock(self, name):
+        os.makedirs(self._working_dir, exist_ok=True)
+        with file_lock(os.path.join(self._working_dir, f"ssm-toolkit-{name}.lock")):
+            yield
+
+    # Same file as JSONFileCache, but written atomically and only readable by
+    # the user, so that other processes never read a partial file
+    def __setitem__(self, cache_key, value):
+        try:
+            content = self._dumps(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Value cannot be cached, must be JSON serializable: {value}")
+        with self.lock("write"):
+            # mkstemp creates the file with mode 0600
+            fd, tmp_file = tempfile.mkstemp(dir=self._working_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(content)
+                os.replace(tmp_file, self._convert_cache_key(cache_key))
+            except OSError:
+                os.unlink(tmp_file)
+                raise
+
+
+__all__.append("register")
+
+
+# Makes the credential providers of session read and write cache
+#
+# Returns:
+# True if the profile of session assumes a role, i.e. its credentials are cached
+def register(session, cache):
+    credential_provider = session._session.get_component("credential_provider")
+    for name in CACHED_PROVIDERS:
+        provider = credential_provider.get_provider(name)
+        if provider is not None:
+            provider.cache = cache
+    config = session._session.get_scoped_config()
+    return any(setting in config for setting in ROLE_SETTINGS)
+
+
+__all__.append("lock_refreshes")
+
+
+# botocore only fetches the credentials of a role when they are first used, by
+# the first API call, and again before they expire.  Every fetch is made to hold
+# the lock of the profile in cache, so that a process waiting for it finds the
+# credentials another process just wrote to the cache instead of calling STS.
+# Nothing is fetched here: building a session never calls STS.
+def lock_refreshes(session, cache):
+    try:
+        credentials = session.get_credentials()
+    except BotoCoreError as e:
+        # Left to the first API call, where the tools report it
+        logger.debug("Could not load credentials of profile %s: %s", session.profile_name, e)
+        return
+    if not isinstance(credentials, RefreshableCredentials):
+        return
+    refresh = credentials._refresh_using
+    profile = hashlib.sha1(session.profile_name.encode()).hexdigest()
+
+    def locked_refresh():
+        with timings.phase("credentials", profile=session.profile_name):
+            with cache.lock(f"fetch-{profile}"):
+                return refresh()
+
+    credentials._refresh_using = locked_refresh
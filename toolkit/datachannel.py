@@ -0,0 +1,558 @@
+# Native client for the Session Manager data channel
+#
+# Port forwarding normally runs 'aws ssm start-session', which starts the
+# session-manager-plugin, so every tunnel costs a Python CLI cold start and two
+# extra processes.  This module speaks the data channel protocol of the plugin
+# itself: the WebSocket returned by StartSession is served from the same asyncio
+# loop as the local listener.
+#
+# Every message on the WebSocket is a binary ClientMessage (116 byte header,
+# SHA-256 digest of the payload).  Stream data is numbered in both directions and
+# every message received is acknowledged; messages sent are kept until the agent
+# acknowledges them and resent otherwise.  Agents newer than 3.0.196.0 multiplex
+# the TCP connections of a port session with smux v1 inside the stream data.
+#
+# Requires the optional websockets package:
+#   pip install aws-systems-manager-toolkit[native]
+#
+# Email: SRE@vonage.com
+
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import struct
+import time
+import uuid
+from . import aio
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+__all__ = []
+
+logger = logging.getLogger()
+
+# Version reported to the agent, the plugin version whose protocol is implemented
+CLIENT_VERSION = "1.2.0.0"
+
+SCHEMA_VERSION = 1
+
+# HeaderLength, MessageType, SchemaVersion, CreatedDate, SequenceNumber, Flags,
+# MessageId, PayloadDigest, PayloadType, PayloadLength
+HEADER = struct.Struct(">I32sIQqQ16s32sII")
+HEADER_LENGTH = HEADER.size - 4
+
+INPUT_STREAM_DATA = "input_stream_data"
+OUTPUT_STREAM_DATA = "output_stream_data"
+ACKNOWLEDGE = "acknowledge"
+CHANNEL_CLOSED = "channel_closed"
+START_PUBLICATION = "start_publication"
+PAUSE_PUBLICATION = "pause_publication"
+
+# Payload types
+OUTPUT = 1
+ERROR = 2
+HANDSHAKE_REQUEST = 5
+HANDSHAKE_RESPONSE = 6
+HANDSHAKE_COMPLETE = 7
+ENC_CHALLENGE_REQUEST = 8
+FLAG = 10
+
+# Flag payloads
+DISCONNECT_TO_PORT = 1
+TERMINATE_SESSION = 2
+CONNECT_TO_PORT_ERROR = 3
+
+# Handshake action statuses
+ACTION_SUCCESS = 1
+ACTION_UNSUPPORTED = 3
+
+# Stream data is sent in chunks of this many bytes, like the plugin does
+STREAM_DATA_PAYLOAD_SIZE = 1024
+
+# Messages sent and not acknowledged yet before sending waits
+MAX_UNACKNOWLEDGED = 1000
+
+# Seconds after which a message that was not acknowledged is sent again
+RESEND_TIMEOUT = 1
+
+# Seconds the agent has to complete the handshake
+HANDSHAKE_TIMEOUT = 15
+
+# smux v1: version, command, length, stream id
+SMUX_HEADER = struct.Struct("<BBHI")
+SMUX_VERSION = 1
+SMUX_SYN = 0
+SMUX_FIN = 1
+SMUX_PSH = 2
+SMUX_NOP = 3
+SMUX_MAX_FRAME_SIZE = 32768
+
+# Seconds between two smux keepalives, the agent drops silent sessions after 30
+SMUX_KEEPALIVE_INTERVAL = 10
+
+# Port sessions are multiplexed by agents newer than this version
+MUX_SUPPORTED_AFTER_AGENT_VERSION = "3.0.196.0"
+
+
+__all__.append("is_available")
+
+
+def is_available():
+    return websockets is not None
+
+
+__all__.append("DataChannelError")
+
+
+class DataChannelError(Exception):
+    pass
+
+
+# The plugin writes the least significant half of the UUID first
+def encode_message_id(message_id):
+    return message_id.bytes[8:] + message_id.bytes[:8]
+
+
+def decode_message_id(data):
+    return uuid.UUID(bytes=data[8:] + data[:8])
+
+
+def parse_version(version):
+    try:
+        return tuple(int(part) for part in version.split("."))
+    except (AttributeError, ValueError):
+        return ()
+
+
+def supports_mux(agent_version):
+    return parse_version(agent_version) > parse_version(MUX_SUPPORTED_AFTER_AGENT_VERSION)
+
+
+__all__.append("ClientMessage")
+
+
+class ClientMessage(object):
+    __slots__ = ("message_type", "payload", "payload_type", "sequence_number",
+                 "flags", "message_id", "created_date")
+
+    def __init__(self, message_type, payload=b"", payload_type=0, sequence_number=0,
+                 flags=0, message_id=None, created_date=None):
+        self.message_type = message_type
+        self.payload = payload
+        self.payload_type = payload_type
+        self.sequence_number = sequence_number
+        self.flags = flags
+        self.message_id = message_id or uuid.uuid4()
+        self.created_date = created_date or int(time.time() * 1000)
+
+    def serialize(self):
+        return HEADER.pack(
+            HEADER_LENGTH, self.message_type.encode().ljust(32, b" "), SCHEMA_VERSION,
+            self.created_date, self.sequence_number, self.flags,
+            encode_message_id(self.message_id), hashlib.sha256(self.payload).digest(),
+            self.payload_type, len(self.payload)) + self.payload
+
+    @classmethod
+    def deserialize(cls, data):
+        if len(data) < HEADER.size:
+            raise ValueError(f"Message of {len(data)} bytes is shorter than the header")
+        (header_length, message_type, _, created_date, sequence_number, flags,
+         message_id, digest, payload_type, payload_length) = HEADER.unpack_from(data)
+        payload = bytes(data[header_length + 4:header_length + 4 + payload_length])
+        if len(payload) != payload_length or hashlib.sha256(payload).digest() != digest:
+            raise ValueError(f"Invalid payload in message {decode_message_id(message_id)}")
+        return cls(message_type.rstrip(b" \x00").decode(), payload, payload_type,
+                   sequence_number, flags, decode_message_id(message_id), created_date)
+
+
+__all__.append("DataChannel")
+
+
+# One Session Manager data channel.  Stream data received from the agent is
+# passed in order to the on_output coroutine function.
+class DataChannel(object):
+
+    def __init__(self, stream_url, token_value, on_output=None):
+        self.stream_url = stream_url
+        self.token_value = token_value
+        self.on_output = on_output
+        self.websocket = None
+        self.sequence_number = 0
+        self.expected_sequence_number = 0
+        self.out_of_order = {}
+        self.unacknowledged = collections.OrderedDict()
+        self.acknowledged = asyncio.Event()
+        self.publishing = asyncio.Event()
+        self.publishing.set()
+        self.handshake_complete = asyncio.Event()
+        self.send_lock = asyncio.Lock()
+        self.closed = asyncio.Event()
+        self.error = None
+        self.agent_version = None
+        self.session_type = None
+        self.session_properties = {}
+        self.tasks = []
+
+    async def open(self):
+        self.websocket = await websockets.connect(self.stream_url, max_size=None)
+        await self.websocket.send(json.dumps({
+            "MessageSchemaVersion": "1.0",
+            "RequestId": str(uuid.uuid4()),
+            "TokenValue": self.token_value,
+            "ClientId": str(uuid.uuid4()),
+            "ClientVersion": CLIENT_VERSION,
+        }))
+        self.tasks = [asyncio.ensure_future(self.receive()),
+                      asyncio.ensure_future(self.resend())]
+
+        waiters = [asyncio.ensure_future(self.handshake_complete.wait()),
+                   asyncio.ensure_future(self.closed.wait())]
+        done, pending = await asyncio.wait(
+            waiters, timeout=HANDSHAKE_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+        if not self.handshake_complete.is_set():
+            error = self.error or ("Data channel closed during the handshake" if self.closed.is_set()
+                                   else "Session handshake timed out")
+            await self.close()
+            raise DataChannelError(error)
+        logger.debug("Handshake with agent %s complete, session type %s",
+                     self.agent_version, self.session_type)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.websocket is not None:
+            await self.websocket.close()
+        self.closed.set()
+
+    async def receive(self):
+        try:
+            async for data in self.websocket:
+                if isinstance(data, str):
+                    continue
+                try:
+                    message = ClientMessage.deserialize(data)
+                except ValueError as e:
+                    # Not acknowledged, so the agent sends it again
+                    logger.debug("Dropping message: %s", e)
+                    continue
+                await self.handle(message)
+        except websockets.exceptions.ConnectionClosed as e:
+            logger.debug("Data channel closed: %s", e)
+        except DataChannelError as e:
+            self.error = str(e)
+        finally:
+            self.closed.set()
+            # Wake up the senders waiting for the agent
+            self.acknowledged.set()
+            self.publishing.set()
+
+    async def handle(self, message):
+        if message.message_type == ACKNOWLEDGE:
+            acknowledgement = json.loads(message.payload)
+            self.unacknowledged.pop(acknowledgement["AcknowledgedMessageSequenceNumber"], None)
+            self.acknowledged.set()
+        elif message.message_type == OUTPUT_STREAM_DATA:
+            await self.acknowledge(message)
+            if message.sequence_number == self.expected_sequence_number:
+                await self.process(message)
+                self.expected_sequence_number += 1
+                # Messages that arrived early can be processed now
+                while self.expected_sequence_number in self.out_of_order:
+                    await self.process(self.out_of_order.pop(self.expected_sequence_number))
+                    self.expected_sequence_number += 1
+            elif message.sequence_number > self.expected_sequence_number:
+                self.out_of_order[message.sequence_number] = message
+        elif message.message_type == CHANNEL_CLOSED:
+            output = json.loads(message.payload).get("Output")
+            if output:
+                logger.info(output)
+            await self.websocket.close()
+        elif message.message_type == START_PUBLICATION:
+            self.publishing.set()
+        elif message.message_type == PAUSE_PUBLICATION:
+            self.publishing.clear()
+
+    async def process(self, message):
+        if message.payload_type == HANDSHAKE_REQUEST:
+            await self.handshake(json.loads(message.payload))
+        elif message.payload_type == HANDSHAKE_COMPLETE:
+            self.handshake_complete.set()
+        elif message.payload_type == ENC_CHALLENGE_REQUEST:
+            raise DataChannelError("Session encryption is not supported by the native client")
+        elif message.payload_type == FLAG:
+            flag, = struct.unpack(">I", message.payload[:4])
+            if flag == CONNECT_TO_PORT_ERROR:
+                logger.error("The agent could not connect to the remote port")
+        elif message.payload_type == ERROR:
+            logger.error(message.payload.decode(errors="replace"))
+        elif message.payload_type == OUTPUT and self.on_output:
+            await self.on_output(message.payload)
+
+    async def handshake(self, request):
+        self.agent_version = request.get("AgentVersion")
+        processed = []
+        errors = []
+        for action in request.get("RequestedClientActions", []):
+            if action["ActionType"] == "SessionType":
+                parameters = action["ActionParameters"]
+                if isinstance(parameters, str):
+                    parameters = json.loads(parameters)
+                self.session_type = parameters.get("SessionType")
+                self.session_properties = parameters.get("Properties") or {}
+                processed.append({"ActionType": "SessionType", "ActionStatus": ACTION_SUCCESS})
+            else:
+                # KMSEncryption needs the KMS data key exchange of the plugin
+                processed.append({"ActionType": action["ActionType"], "ActionStatus": ACTION_UNSUPPORTED,
+                                  "Error": f"{action['ActionType']} is not supported"})
+                errors.append(f"{action['ActionType']} is not supported by the native client")
+        await self.send_input(HANDSHAKE_RESPONSE, json.dumps({
+            "ClientVersion": CLIENT_VERSION,
+            "ProcessedClientActions": processed,
+            "Errors": errors,
+        }).encode())
+        if errors:
+            raise DataChannelError(", ".join(errors))
+
+    async def acknowledge(self, message):
+        await self.websocket.send(ClientMessage(ACKNOWLEDGE, json.dumps({
+            "AcknowledgedMessageType": message.message_type,
+            "AcknowledgedMessageId": str(message.message_id),
+            "AcknowledgedMessageSequenceNumber": message.sequence_number,
+            "IsSequentialMessage": True,
+        }).encode(), flags=3).serialize())
+
+    async def send_input(self, payload_type, payload):
+        while len(self.unacknowledged) >= MAX_UNACKNOWLEDGED and not self.closed.is_set():
+            self.acknowledged.clear()
+            await self.acknowledged.wait()
+        await self.publishing.wait()
+        if self.closed.is_set():
+            raise DataChannelError("Data channel is closed")
+        message = ClientMessage(INPUT_STREAM_DATA, payload, payload_type,
+                                self.sequence_number, 1 if self.sequence_number == 0 else 0)
+        self.sequence_number += 1
+        data = message.serialize()
+        self.unacknowledged[message.sequence_number] = [data, time.time()]
+        try:
+            await self.websocket.send(data)
+        except websockets.exceptions.ConnectionClosed as e:
+            raise DataChannelError(f"Data channel is closed: {e}")
+
+    # Sends data as stream data.  Concurrent callers do not interleave, which
+    # keeps smux frames contiguous.
+    async def send_data(self, data):
+        async with self.send_lock:
+            for start in range(0, len(data), STREAM_DATA_PAYLOAD_SIZE):
+                await self.send_input(OUTPUT, data[start:start + STREAM_DATA_PAYLOAD_SIZE])
+
+    async def send_flag(self, flag):
+        async with self.send_lock:
+            await self.send_input(FLAG, struct.pack(">I", flag))
+
+    async def resend(self):
+        while not self.closed.is_set():
+            await asyncio.sleep(RESEND_TIMEOUT)
+            now = time.time()
+            for sequence_number, entry in list(self.unacknowledged.items()):
+                if now - entry[1] < RESEND_TIMEOUT:
+                    break
+                logger.debug("Resending message %d", sequence_number)
+                entry[1] = now
+                try:
+                    await self.websocket.send(entry[0])
+                except websockets.exceptions.ConnectionClosed:
+                    return
+
+
+# Port session of an agent supporting multiplexing: every local connection is
+# one smux stream
+class MuxPort(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.buffer = bytearray()
+        self.streams = {}
+        self.next_stream_id = 1
+        self.keepalive = asyncio.ensure_future(self.send_keepalive())
+
+    async def on_output(self, data):
+        self.buffer += data
+        while len(self.buffer) >= SMUX_HEADER.size:
+            _, command, length, stream_id = SMUX_HEADER.unpack_from(self.buffer)
+            if len(self.buffer) < SMUX_HEADER.size + length:
+                break
+            payload = bytes(self.buffer[SMUX_HEADER.size:SMUX_HEADER.size + length])
+            del self.buffer[:SMUX_HEADER.size + length]
+            writer = self.streams.get(stream_id)
+            if writer is None:
+                continue
+            if command == SMUX_PSH:
+                if writer.is_closing():
+                    # The local end went away, tell the agent
+                    del self.streams[stream_id]
+                    asyncio.ensure_future(self.close_stream(stream_id))
+                else:
+                    # Not drained: waiting here would also hold back the
+                    # acknowledgements of the other streams
+                    writer.write(payload)
+            elif command == SMUX_FIN:
+                del self.streams[stream_id]
+                writer.close()
+
+    async def send_frame(self, command, stream_id, payload=b""):
+        await self.channel.send_data(
+            SMUX_HEADER.pack(SMUX_VERSION, command, len(payload), stream_id) + payload)
+
+    async def close_stream(self, stream_id):
+        try:
+            await self.send_frame(SMUX_FIN, stream_id)
+        except DataChannelError:
+            pass
+
+    async def send_keepalive(self):
+        try:
+            while True:
+                await asyncio.sleep(SMUX_KEEPALIVE_INTERVAL)
+                await self.send_frame(SMUX_NOP, 0)
+        except DataChannelError:
+            pass
+
+    async def serve(self, reader, writer):
+        stream_id = self.next_stream_id
+        self.next_stream_id += 2
+        self.streams[stream_id] = writer
+        try:
+            await self.send_frame(SMUX_SYN, stream_id)
+            while True:
+                data = await reader.read(SMUX_MAX_FRAME_SIZE)
+                if not data:
+                    break
+                await self.send_frame(SMUX_PSH, stream_id, data)
+            if self.streams.pop(stream_id, None) is not None:
+                await self.send_frame(SMUX_FIN, stream_id)
+        except (ConnectionError, DataChannelError) as e:
+            logger.debug("Stream %d closed: %s", stream_id, e)
+        except asyncio.CancelledError:
+            # Shutting down, end the connection like a normal close
+            pass
+        finally:
+            self.streams.pop(stream_id, None)
+            writer.close()
+
+    def close(self):
+        self.keepalive.cancel()
+
+
+# Port session of older agents: one local connection at a time
+class BasicPort(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def on_output(self, data):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(data)
+
+    async def serve(self, reader, writer):
+        async with self.lock:
+            self.writer = writer
+            try:
+                while True:
+                    data = await reader.read(STREAM_DATA_PAYLOAD_SIZE)
+                    if not data:
+                        break
+                    await self.channel.send_data(data)
+                await self.channel.send_flag(DISCONNECT_TO_PORT)
+            except (ConnectionError, DataChannelError) as e:
+                logger.debug("Connection closed: %s", e)
+            except asyncio.CancelledError:
+                # Shutting down, end the connection like a normal close
+                pass
+            finally:
+                self.writer = None
+                writer.close()
+
+    def close(self):
+        pass
+
+
+__all__.append("PortForwardSession")
+
+
+# AWS-StartPortForwardingSession served natively.
+#
+# Parameters:
+# ssm - SSM Boto3 Client
+# instance_id - instance to start the session with
+# remote_port - port on the instance
+# local_port - local port to listen on, unless sock is given
+# sock - listening socket to serve instead of binding local_port
+class PortForwardSession(object):
+
+    def __init__(self, ssm, instance_id, remote_port, local_port=None, sock=None):
+        self.ssm = ssm
+        self.instance_id = instance_id
+        self.remote_port = str(remote_port)
+        self.local_port = local_port
+        self.sock = sock
+        self.session_id = None
+
+    async def start(self):
+        response = await aio.call(
+            self.ssm.start_session, Target=self.instance_id,
+            DocumentName="AWS-StartPortForwardingSession",
+            Parameters={"portNumber": [self.remote_port], "localPortNumber": [str(self.local_port or 0)]})
+        self.session_id = response["SessionId"]
+        print(f"\nStarting session with SessionId: {self.session_id}")
+
+        self.channel = DataChannel(response["StreamUrl"], response["TokenValue"])
+        await self.channel.open()
+        if self.channel.session_type != "Port":
+            await self.channel.close()
+            raise DataChannelError(f"Unexpected session type {self.channel.session_type}")
+        if supports_mux(self.channel.agent_version):
+            self.port = MuxPort(self.channel)
+        else:
+            self.port = BasicPort(self.channel)
+        self.channel.on_output = self.port.on_output
+
+        if self.sock is not None:
+            self.server = await asyncio.start_server(self.port.serve, sock=self.sock)
+        else:
+            self.server = await asyncio.start_server(self.port.serve, "localhost", self.local_port)
+        local_port = self.server.sockets[0].getsockname()[1]
+        print(f"Port {local_port} opened for sessionId {self.session_id}.")
+        print("Waiting for connections...\n")
+
+    # Serves connections until the agent closes the data channel
+    async def serve(self):
+        await self.start()
+        try:
+            await self.channel.closed.wait()
+            if self.channel.error:
+                logger.error(self.channel.error)
+        finally:
+            self.server.close()
+            self.port.close()
+            if not self.channel.closed.is_set():
+                try:
+                    await asyncio.wait_for(self.channel.send_flag(TERMINATE_SESSION), 1)
+                except (asyncio.TimeoutError, DataChannelError):
+                    pass
+            await self.channel.close()
+
+    # Synchronous, so it can run after the event loop was interrupted
+    def terminate(self):
+        if self.session_id:
+            self.ssm.terminate_session(SessionId=self.session_id)
+            print(f"\nExiting session with sessionId: {self.session_id}.\n")
+            self.session_id = None
@@ -0,0 +1,41 @@
+# Advisory file lock shared by the caches kept in ~/.ssm_toolkit
+#
+# Email: SRE@vonage.com
+
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+__all__ = []
+
+
+__all__.append("file_lock")
+
+
+# Holds an exclusive lock on path for the duration of the with block.  The lock
+# file is created if needed and is never removed, so all processes agree on the
+# same inode.
+@contextlib.contextmanager
+def file_lock(path):
+    with open(path, "a+") as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        elif msvcrt:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            elif msvcrt:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
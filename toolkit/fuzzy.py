@@ -0,0 +1,181 @@
+# Fuzzy search and interactive picker over the SSM inventory
+#
+# Instance names, host names, addresses, instance ids and tag values are
+# indexed by trigram once, so a query only looks at the instances sharing at
+# least one trigram with it.  Results are ranked by the share of the query's
+# trigrams they contain, with a bonus for substring and exact matches, which
+# tolerates typos and partial names.  Searching never calls AWS: the inventory
+# comes from ssm-toolkitd when it is running, or from the cache written by
+# ssm-list.
+#
+# Email: SRE@vonage.com
+
+import boto3
+import botocore.exceptions
+import heapq
+import logging
+import sys
+from . import toolkitd
+from .inventory import get_inventory_cache_file, read_records
+
+__all__ = []
+
+logger = logging.getLogger()
+
+# Results whose score is below this are not returned
+MIN_SCORE = 0.5
+
+# Maximum number of instances offered by the picker
+MAX_CHOICES = 20
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+__all__.append("TrigramIndex")
+
+
+class TrigramIndex(object):
+
+    def __init__(self, records):
+        self.records = list(records)
+        # Searchable values of every record, lower case and newline separated
+        self.texts = []
+        self.postings = {}
+        for position, record in enumerate(self.records):
+            values = [record.instance_name, record.host_name, record.private_ip,
+                      record.public_ip, record.instance_id]
+            values.extend(value for key, value in record.tags if key != "Name")
+            text = "\n".join(value.lower() for value in values if value)
+            self.texts.append(f"\n{text}\n")
+            for trigram in trigrams(text):
+                self.postings.setdefault(trigram, []).append(position)
+
+    def score(self, position, query, hits, query_trigrams):
+        score = hits / len(query_trigrams) if query_trigrams else 0
+        text = self.texts[position]
+        if query in text:
+            score += 1
+            if f"\n{query}\n" in text:
+                score += 1
+        return score
+
+    # Returns:
+    # Up to limit (InventoryRecord, score) tuples, best match first
+    def search(self, query, limit=MAX_CHOICES):
+        query = query.lower().strip()
+        if not query:
+            return []
+        query_trigrams = trigrams(query)
+        if query_trigrams:
+            hits = {}
+            for trigram in query_trigrams:
+                for position in self.postings.get(trigram, ()):
+                    hits[position] = hits.get(position, 0) + 1
+        else:
+            # Too short for trigrams, fall back to a substring scan
+            hits = {position: 0 for position, text in enumerate(self.texts) if query in text}
+
+        scores = {}
+        for position, count in hits.items():
+            score = self.score(position, query, count, query_trigrams)
+            if score >= MIN_SCORE:
+                scores[position] = score
+        # Equal scores favour the shortest names, closer to the query
+        best = heapq.nsmallest(limit, scores, key=lambda position: (
+            -scores[position], len(self.records[position].sort_key()),
+            self.records[position].sort_key()))
+        return [(self.records[position], scores[position]) for position in best]
+
+
+__all__.append("load_inventory")
+
+
+# Returns:
+# List of InventoryRecord of profile and region, from ssm-toolkitd or the
+# ssm-list cache, without calling AWS.  Empty if neither is available.
+def load_inventory(profile=None, region=None):
+    inventory = toolkitd.get_inventory(profile, region)
+    if inventory is not None:
+        return list(inventory.values())
+    profile = profile or "default"
+    try:
+        # Same region as the session of the tool when none is given
+        region = region or boto3.Session(
+            profile_name=None if profile == "default" else profile).region_name
+        with open(get_inventory_cache_file()) as f:
+            return [record for record in read_records(f)
+                    if (record.profile or "default") == profile and record.region == region]
+    except (IOError, ValueError, KeyError, botocore.exceptions.BotoCoreError) as e:
+        logger.debug("Inventory cache not usable: %s", e)
+        return []
+
+
+__all__.append("search")
+
+
+# Returns:
+# Up to limit InventoryRecord matching query, best match first
+def search(query, profile=None, region=None, limit=MAX_CHOICES):
+    results = toolkitd.search(query, profile, region, limit)
+    if results is not None:
+        return results
+    return [record for record, score in
+            TrigramIndex(load_inventory(profile, region)).search(query, limit)]
+
+
+__all__.append("can_prompt")
+
+
+def can_prompt():
+    return sys.stdin.isatty() and sys.stderr.isatty()
+
+
+__all__.append("pick_instance")
+
+
+# Lets the user choose the instance meant by target on the terminal.  An
+# ambiguous target offers the instances it matched, a target that matched
+# nothing offers the closest fuzzy matches from the inventory.
+#
+# Parameters:
+# target - instance name, host name or address given by the user
+# instance_ids - instance ids target resolved to, if any
+#
+# Returns:
+# The chosen instance id, None if there was nothing to choose or no choice made
+def pick_instance(target, instance_ids, profile=None, region=None):
+    if instance_ids:
+        known = {record.instance_id: record for record in load_inventory(profile, region)}
+        choices = [known[instance_id] for instance_id in instance_ids if instance_id in known]
+        choices.sort(key=lambda record: record.sort_key())
+        choices += [instance_id for instance_id in instance_ids if instance_id not in known]
+    else:
+        choices = search(target, profile, region)
+    if not choices:
+        return None
+
+    print(f"Instances matching '{target}':", file=sys.stderr)
+    more = len(choices) - MAX_CHOICES
+    choices = choices[:MAX_CHOICES]
+    for number, choice in enumerate(choices, 1):
+        if isinstance(choice, str):
+            print(f"{number:3}) {choice}", file=sys.stderr)
+        else:
+            print(f"{number:3}) {choice.instance_id}   {choice.host_name}   {choice.instance_name}   "
+                  f"{' '.join(choice.addresses)}", file=sys.stderr)
+    if more > 0:
+        print(f"     ... and {more} more, use a more specific target to see them", file=sys.stderr)
+    while True:
+        try:
+            print(f"Select instance [1-{len(choices)}], empty to cancel: ", end="", file=sys.stderr, flush=True)
+            answer = sys.stdin.readline().strip()
+        except KeyboardInterrupt:
+            print(file=sys.stderr)
+            return None
+        if not answer:
+            return None
+        if answer.isdigit() and 1 <= int(answer) <= len(choices):
+            choice = choices[int(answer) - 1]
+            return choice if isinstance(choice, str) else choice.instance_id
@@ -0,0 +1,140 @@
+# Compact representation of the SSM inventory
+#
+# One InventoryRecord per instance, with __slots__ instead of a dict of dicts,
+# and interned strings for the values shared by many instances (tag keys and
+# common tag values).  Inventories too large to sort in memory can be sorted
+# externally: records are written to temporary files in sorted runs which are
+# then merged lazily.
+#
+# Email: SRE@vonage.com
+
+import heapq
+import json
+import os
+import sys
+import tempfile
+
+__all__ = []
+
+# Number of records sorted in memory per run of an external sort
+SORT_RUN_SIZE = 10000
+
+
+__all__.append("InventoryRecord")
+
+
+class InventoryRecord(object):
+    __slots__ = ("instance_id", "host_name", "instance_name", "private_dns_name",
+                 "private_ip", "public_ip", "tags", "profile", "region")
+
+    def __init__(self, instance_id, host_name="", instance_name="", private_dns_name="",
+                 private_ip="", public_ip="", tags=(), profile=None, region=None):
+        self.instance_id = instance_id
+        self.host_name = host_name
+        self.instance_name = instance_name
+        self.private_dns_name = private_dns_name
+        self.private_ip = private_ip
+        self.public_ip = public_ip
+        # Tuple of (key, value) pairs, much smaller than a dict per instance
+        self.tags = tuple((sys.intern(key), sys.intern(value)) for key, value in tags)
+        self.profile = profile
+        self.region = region
+
+    @property
+    def addresses(self):
+        return [self.private_ip, self.public_ip]
+
+    def get_tag(self, key, default=None):
+        for tag_key, value in self.tags:
+            if tag_key == key:
+                return value
+        return default
+
+    def sort_key(self):
+        return self.instance_name or self.host_name
+
+    def to_dict(self):
+        return {
+            "InstanceId": self.instance_id,
+            "HostName": self.host_name,
+            "InstanceName": self.instance_name,
+            "PrivateDnsName": self.private_dns_name,
+            "Addresses": self.addresses,
+            "Tags": dict(self.tags),
+            "Profile": self.profile,
+            "Region": self.region,
+        }
+
+    @classmethod
+    def from_dict(cls, item):
+        private_ip, public_ip = (item.get("Addresses", []) + ["", ""])[:2]
+        return cls(item["InstanceId"], item.get("HostName", ""), item.get("InstanceName", ""),
+                   item.get("PrivateDnsName", ""), private_ip, public_ip,
+                   item.get("Tags", {}).items(), item.get("Profile"), item.get("Region"))
+
+    def __repr__(self):
+        return f"InventoryRecord({self.to_dict()!r})"
+
+
+__all__.append("get_inventory_cache_file")
+
+
+# Inventory written by ssm-list on every run, one JSON record per line
+def get_inventory_cache_file():
+    return os.path.join(os.path.expanduser('~'), '.ssm_inventory_cache')
+
+
+__all__.append("write_records")
+
+
+def write_records(f, records):
+    for record in records:
+        f.write(json.dumps(record.to_dict()))
+        f.write("\n")
+
+
+__all__.append("read_records")
+
+
+def read_records(f):
+    for line in f:
+        if line.strip():
+            yield InventoryRecord.from_dict(json.loads(line))
+
+
+__all__.append("ExternalSort")
+
+
+# Sorts records by InventoryRecord.sort_key keeping at most run_size of them
+# in memory.  Records are added in any number of batches; iterating merges the
+# sorted runs written to temporary files, which are removed afterwards.
+class ExternalSort(object):
+
+    def __init__(self, run_size=SORT_RUN_SIZE):
+        self.run_size = run_size
+        self.run = []
+        self.runs = []
+
+    def add(self, records):
+        self.run.extend(records)
+        if len(self.run) >= self.run_size:
+            self.flush()
+
+    def flush(self):
+        if not self.run:
+            return
+        self.run.sort(key=InventoryRecord.sort_key)
+        f = tempfile.TemporaryFile("w+")
+        write_records(f, self.run)
+        f.seek(0)
+        self.runs.append(f)
+        self.run = []
+
+    def __iter__(self):
+        self.flush()
+        try:
+            yield from heapq.merge(*[read_records(f) for f in self.runs], key=InventoryRecord.sort_key)
+        finally:
+            for f in self.runs:
+                f.close()
+            self.runs = []
@@ -0,0 +1,181 @@
+# Run journal for ssm-run
+#
+# Every ssm-run invocation is recorded in ~/.ssm_toolkit/runs/RUN_ID.json with
+# the commands, the resolved targets and the status and output of every
+# instance.  This allows showing past results without calling
+# list_command_invocations again, and re-running only the instances that
+# failed or never finished.
+#
+# Email: SRE@vonage.com
+
+import datetime
+import os
+import time
+import uuid
+from .aio import FINAL_STATUSES
+from .common import get_toolkit_dir, read_json, write_json
+
+__all__ = []
+
+# Number of journal files kept, older runs are removed
+MAX_RUNS = 100
+
+# Minimum seconds between two writes of the same journal while a run is in
+# progress.  Rewriting the whole file for every batch of a large run would
+# cost more than the run itself.
+SAVE_INTERVAL = 1
+
+PENDING = "Pending"
+
+# Status of instances sent a command SSM no longer has invocations of, e.g.
+# after the 30 days it keeps them for
+UNKNOWN = "Unknown"
+
+_last_saved = {}
+
+
+def get_run_file(run_id):
+    return os.path.join(get_toolkit_dir("runs"), f"{run_id}.json")
+
+
+__all__.append("new_run")
+
+
+# Parameters:
+# commands - list of shell commands
+# instances - dict of instance id -> target the user asked for
+# targets - SSM Targets of the run when the instances are selected by SSM, in
+#           which case instances is empty and filled by record_invocations
+#
+# Returns:
+# The journal entry for the run, already saved with every instance Pending
+def new_run(commands, instances, profile=None, region=None, targets=None):
+    now = datetime.datetime.now()
+    run = {
+        "RunId": f"{now:%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}",
+        "Created": now.isoformat(),
+        "Profile": profile,
+        "Region": region,
+        "Commands": commands,
+        "CommandIds": [],
+        "Invocations": {}
+    }
+    if targets:
+        run["Targets"] = targets
+    add_instances(run, instances)
+    save_run(run)
+    prune_runs()
+    return run
+
+
+__all__.append("add_instances")
+
+
+def add_instances(run, instances):
+    for instance_id, target in instances.items():
+        run["Invocations"][instance_id] = {
+            "Target": target,
+            "CommandId": None,
+            "Status": PENDING,
+            "Output": []
+        }
+
+
+__all__.append("load_run")
+
+
+def load_run(run_id):
+    return read_json(get_run_file(run_id))
+
+
+__all__.append("save_run")
+
+
+def save_run(run, force=True):
+    now = time.time()
+    if not force and now - _last_saved.get(run["RunId"], 0) < SAVE_INTERVAL:
+        return
+    write_json(get_run_file(run["RunId"]), run)
+    _last_saved[run["RunId"]] = now
+
+
+__all__.append("record_command")
+
+
+def record_command(run, command_id, instance_ids):
+    run["CommandIds"].append(command_id)
+    for instance_id in instance_ids:
+        run["Invocations"][instance_id].update(
+            {"CommandId": command_id, "Status": PENDING, "Output": []})
+    save_run(run, force=False)
+
+
+__all__.append("record_invocations")
+
+
+# Stores the final status and plugin output of CommandInvocations.  Instances
+# not in the run yet are added with target, or their instance id.
+def record_invocations(run, invocations, target=None):
+    for ci in invocations:
+        entry = run["Invocations"].setdefault(
+            ci["InstanceId"], {"Target": target or ci["InstanceId"]})
+        entry.update({
+            "CommandId": ci["CommandId"],
+            "Status": ci["Status"],
+            "Output": [command.get("Output", "") for command in ci.get("CommandPlugins", [])]
+        })
+    save_run(run, force=False)
+
+
+__all__.append("refresh_invocations")
+
+
+# Updates the instances that were sent command_id from its CommandInvocations.
+# With target, the instances not in the run yet are added too, for commands
+# sent with Targets.
+def refresh_invocations(run, command_id, instance_ids, invocations, target=None):
+    invocations = [ci for ci in invocations if ci["InstanceId"] in instance_ids
+                   or (target and ci["InstanceId"] not in run["Invocations"])]
+    record_invocations(run, invocations, target)
+    for instance_id in set(instance_ids) - {ci["InstanceId"] for ci in invocations}:
+        run["Invocations"][instance_id]["Status"] = UNKNOWN
+
+
+__all__.append("get_running")
+
+
+# Returns:
+# Dict of command id -> instance ids the command was sent to but not seen
+# finishing, i.e. that may still be running it
+def get_running(run):
+    running = {}
+    for instance_id, entry in run["Invocations"].items():
+        if entry["CommandId"] and entry["Status"] not in FINAL_STATUSES + [UNKNOWN]:
+            running.setdefault(entry["CommandId"], []).append(instance_id)
+    return running
+
+
+__all__.append("get_unfinished")
+
+
+# Instances that may still be running the commands are left out, so that they
+# never run twice: refresh them with refresh_invocations first.
+#
+# Returns:
+# Dict of instance id -> target for every instance the commands were never
+# sent to or that finished without succeeding
+def get_unfinished(run):
+    return {instance_id: entry["Target"]
+            for instance_id, entry in run["Invocations"].items()
+            if not entry["CommandId"]
+            or (entry["Status"] in FINAL_STATUSES + [UNKNOWN] and entry["Status"] != "Success")}
+
+
+def prune_runs():
+    runs_dir = get_toolkit_dir("runs")
+    run_files = sorted(f for f in os.listdir(runs_dir) if f.endswith(".json"))
+    for run_file in run_files[:-MAX_RUNS]:
+        try:
+            os.remove(os.path.join(runs_dir, run_file))
+        except OSError:
+            pass
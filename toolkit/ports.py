@@ -0,0 +1,132 @@
+# Local port allocation for tunnels
+#
+# Ports are reserved by binding a listening socket and holding it until it is
+# handed over to whatever serves the tunnel, so no other process can take the
+# port in between.  Free ports come from the kernel (bind to port 0) or from a
+# configured range, and the port given to every target is remembered in
+# ~/.ssm_toolkit/ports.json so that the next tunnel to the same target gets the
+# same local port again.
+#
+# Email: SRE@vonage.com
+
+import argparse
+import os
+import random
+import socket
+import sys
+import time
+from .common import get_toolkit_dir, read_json, write_json
+from .filelock import file_lock
+
+__all__ = []
+
+LOCAL_HOST = "127.0.0.1"
+
+# Port assignments not used for this many seconds are forgotten
+ASSIGNMENT_TTL = 30 * 24 * 60 * 60
+
+
+def get_ports_file():
+    return os.path.join(get_toolkit_dir(), "ports.json")
+
+
+__all__.append("parse_port_range")
+
+
+# Parameters:
+# text - range as START-END, both included
+#
+# Returns:
+# Tuple (start, end), raises argparse.ArgumentTypeError if text is not a valid
+# range, so that it can be used as the type of an argument
+def parse_port_range(text):
+    try:
+        start, end = (int(port) for port in text.split("-", 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid port range '{text}', expected START-END")
+    if not 1024 <= start <= end <= 65535:
+        raise argparse.ArgumentTypeError(f"invalid port range '{text}', ports have to be between 1024 and 65535")
+    return start, end
+
+
+__all__.append("bind")
+
+
+# Returns:
+# Listening socket bound to port on the loopback interface, port 0 lets the
+# kernel choose a free port.  Raises OSError if the port is not available.
+def bind(port=0):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        # Same as the servers taking the port over, so a port in TIME_WAIT can
+        # still be reserved.  Only on Linux, where it still refuses a port some
+        # process listens on at any address: on macOS and BSD it would allow
+        # binding 127.0.0.1 next to a listener on 0.0.0.0, on Windows it would
+        # allow stealing ports.
+        if sys.platform.startswith("linux"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((LOCAL_HOST, port))
+        sock.listen(socket.SOMAXCONN)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def bind_in_range(port_range):
+    start, end = port_range
+    # Start at a random port so that concurrent allocations rarely collide
+    offset = random.randint(0, end - start)
+    for i in range(end - start + 1):
+        try:
+            return bind(start + (offset + i) % (end - start + 1))
+        except OSError:
+            continue
+    raise OSError(f"No free port between {start} and {end}")
+
+
+__all__.append("get_assigned_port")
+
+
+def get_assigned_port(key):
+    assignment = read_json(get_ports_file(), {}).get(key)
+    return assignment["Port"] if assignment else None
+
+
+__all__.append("assign_port")
+
+
+def assign_port(key, port):
+    ports_file = get_ports_file()
+    with file_lock(f"{ports_file}.lock"):
+        now = time.time()
+        assignments = {k: assignment for k, assignment in read_json(ports_file, {}).items()
+                       if now - assignment["Used"] < ASSIGNMENT_TTL}
+        assignments[key] = {"Port": port, "Used": now}
+        write_json(ports_file, assignments)
+
+
+__all__.append("reserve")
+
+
+# Parameters:
+# key - remembers the port for this key (e.g. profile and target) and prefers
+#       the port remembered last time, if it is free and in port_range
+# port_range - tuple (start, end) the port has to be in, any free port if None
+#
+# Returns:
+# Listening socket holding the reserved port.  Close it right before the port
+# is bound by another process, or hand it over to the server using it.
+def reserve(key=None, port_range=None):
+    sock = None
+    assigned = get_assigned_port(key) if key else None
+    if assigned and (not port_range or port_range[0] <= assigned <= port_range[1]):
+        try:
+            sock = bind(assigned)
+        except OSError:
+            pass
+    if sock is None:
+        sock = bind_in_range(port_range) if port_range else bind(0)
+    if key:
+        assign_port(key, sock.getsockname()[1])
+    return sock
@@ -0,0 +1,82 @@
+# Instance queries evaluated against the local inventory
+#
+# A query is a list of terms that all have to match (AND):
+#
+#   KEY=GLOB[,GLOB...]    one of the values of KEY matches one of the globs
+#   KEY!=GLOB[,GLOB...]   none of the values of KEY matches any of the globs
+#   KEY~REGEX             one of the values of KEY matches the regular expression
+#
+# KEY is one of id, name, host, dns, ip (private or public address),
+# private-ip, public-ip, profile or tag:TAG-KEY.
+#
+# Email: SRE@vonage.com
+
+import fnmatch
+import re
+
+__all__ = []
+
+FIELDS = {
+    "id": lambda record: [record.instance_id],
+    "name": lambda record: [record.instance_name],
+    "host": lambda record: [record.host_name],
+    "dns": lambda record: [record.private_dns_name],
+    "ip": lambda record: [record.private_ip, record.public_ip],
+    "private-ip": lambda record: [record.private_ip],
+    "public-ip": lambda record: [record.public_ip],
+    "profile": lambda record: [record.profile or "default"],
+}
+
+TERM_REGEX = re.compile(r"^(?P<key>[^=!~]+)(?P<operator>!=|=|~)(?P<value>.*)$")
+
+
+__all__.append("Term")
+
+
+class Term(object):
+
+    def __init__(self, text):
+        match = TERM_REGEX.match(text)
+        if not match:
+            raise ValueError(f"Invalid query term '{text}', expected KEY=GLOB, KEY!=GLOB or KEY~REGEX")
+        self.key, self.operator, value = match.group("key", "operator", "value")
+        if self.key.startswith("tag:"):
+            tag_key = self.key[4:]
+            self.get_values = lambda record: [record.get_tag(tag_key, "")]
+        elif self.key in FIELDS:
+            self.get_values = FIELDS[self.key]
+        else:
+            raise ValueError(f"Unknown query key '{self.key}', expected one of "
+                             f"{', '.join(FIELDS)} or tag:TAG-KEY")
+        if self.operator == "~":
+            try:
+                self.patterns = [re.compile(value)]
+            except re.error as e:
+                raise ValueError(f"Invalid regular expression in '{text}': {e}")
+        else:
+            self.patterns = [re.compile(fnmatch.translate(glob)) for glob in value.split(",")]
+
+    def matches(self, record):
+        if self.operator == "~":
+            found = any(self.patterns[0].search(value) for value in self.get_values(record) if value)
+        else:
+            found = any(pattern.match(value) for value in self.get_values(record) if value
+                        for pattern in self.patterns)
+        return not found if self.operator == "!=" else found
+
+
+__all__.append("parse_query")
+
+
+# Raises ValueError on the first term that cannot be parsed
+def parse_query(terms):
+    return [Term(term) for term in terms]
+
+
+__all__.append("select")
+
+
+# Returns:
+# The records matching every term
+def select(records, terms):
+    return [record for record in records if all(term.matches(record) for term in terms)]
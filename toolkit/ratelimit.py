@@ -0,0 +1,171 @@
+# Client-side rate limiting of AWS API calls
+#
+# Every boto3 session built by toolkit.common.get_session takes a token from a
+# token bucket before each API call.  There is one bucket per (profile, region,
+# service, operation), shared by all the clients and threads of the process.
+# Buckets adapt to the service: the rate is halved whenever a call is
+# throttled, and slowly grows back to its configured value on success.
+#
+# With SSM_TOOLKIT_SHARED_RATE_LIMIT=1 the bucket state is kept in a file under
+# ~/.ssm_toolkit guarded by a file lock, so that concurrent ssm-* processes of
+# the same user share the same budget.
+#
+# Email: SRE@vonage.com
+
+import json
+import logging
+import threading
+import time
+from .filelock import file_lock
+
+__all__ = []
+
+
+logger = logging.getLogger()
+
+# Sustained calls per second and burst size per service
+RATES = {
+    "ec2": (20, 100),
+    "ssm": (10, 20),
+    "sts": (10, 20),
+}
+DEFAULT_RATE = (10, 20)
+
+# Lowest rate a bucket is slowed down to after throttling
+MIN_RATE = 0.5
+
+# Calls per second given back to a bucket after each successful call
+RATE_STEP = 0.1
+
+THROTTLING_ERROR_CODES = [
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "RequestThrottled",
+    "SlowDown",
+]
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    # Takes one token and returns the number of seconds the caller has to wait
+    # before using it.  Tokens can be reserved ahead, which keeps waiting
+    # callers in order.
+    def take(self):
+        return self._update(self._take)
+
+    def throttled(self):
+        self._update(self._throttled)
+
+    def succeeded(self):
+        self._update(self._succeeded)
+
+    def _update(self, func):
+        with self.lock:
+            return func()
+
+    def _take(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.timestamp) * self.rate)
+        self.timestamp = now
+        self.tokens -= 1
+        return max(0, -self.tokens / self.rate)
+
+    def _throttled(self):
+        self.rate = max(MIN_RATE, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+
+    def _succeeded(self):
+        self.rate = min(self.max_rate, self.rate + RATE_STEP)
+
+
+class SharedTokenBucket(TokenBucket):
+
+    def __init__(self, key, rate, burst, state_file):
+        super(SharedTokenBucket, self).__init__(rate, burst)
+        self.key = key
+        self.state_file = state_file
+
+    # Loads the state stored for this bucket, applies func and stores it back
+    # while holding the lock file
+    def _update(self, func):
+        with self.lock, file_lock(f"{self.state_file}.lock"):
+            try:
+                with open(self.state_file) as f:
+                    buckets = json.load(f)
+            except (IOError, ValueError):
+                buckets = {}
+            state = buckets.get(self.key, {})
+            self.tokens = state.get("tokens", self.burst)
+            self.rate = state.get("rate", self.max_rate)
+            self.timestamp = state.get("timestamp", time.time())
+
+            result = func()
+
+            buckets[self.key] = {"tokens": self.tokens,
+                                 "rate": self.rate, "timestamp": self.timestamp}
+            with open(self.state_file, "w") as f:
+                json.dump(buckets, f)
+            return result
+
+
+def get_bucket(profile, region, service, operation, state_file=None):
+    key = f"{profile}/{region}/{service}/{operation}"
+    with _buckets_lock:
+        if key not in _buckets:
+            rate, burst = RATES.get(service, DEFAULT_RATE)
+            if state_file:
+                _buckets[key] = SharedTokenBucket(key, rate, burst, state_file)
+            else:
+                _buckets[key] = TokenBucket(rate, burst)
+        return _buckets[key]
+
+
+__all__.append("register")
+
+
+# Parameters:
+# session - boto3 Session the clients will be created from
+# state_file - file holding the bucket state shared across processes, if any
+def register(session, state_file=None):
+    profile = session.profile_name
+
+    def get_session_bucket(event_name, context):
+        _, service, operation = event_name.split(".")
+        region = context.get("client_region")
+        return get_bucket(profile, region, service, operation, state_file)
+
+    def before_call(event_name, context, **kwargs):
+        wait = get_session_bucket(event_name, context).take()
+        if wait:
+            logger.debug("Rate limit: waiting %.2fs before %s", wait, event_name)
+            time.sleep(wait)
+
+    def needs_retry(event_name, response, request_dict, **kwargs):
+        if response is None:
+            return
+        bucket = get_session_bucket(event_name, request_dict.get("context", {}))
+        error_code = response[1].get("Error", {}).get("Code")
+        if error_code in THROTTLING_ERROR_CODES:
+            logger.debug("Rate limit: %s throttled, slowing down", event_name)
+            bucket.throttled()
+        elif response[0].status_code < 300:
+            bucket.succeeded()
+
+    session.events.register("before-call", before_call)
+    session.events.register("needs-retry", needs_retry)
@@ -0,0 +1,137 @@
+# Script payloads for ssm-run --script
+#
+# The script is gzip compressed and identified by the SHA-256 of its content.
+# It is staged once, either inline as base64 lines of the command or uploaded
+# to S3 under its hash, and every instance runs a small bootstrap that keeps
+# the script in REMOTE_CACHE_DIR: the payload is only decoded or downloaded
+# when the instance does not have a copy with the right hash yet.  The
+# bootstrap refuses a cache directory other users could write to, and runs a
+# private copy of the script whose hash it has just verified.
+#
+# Email: SRE@vonage.com
+
+import base64
+import gzip
+import hashlib
+import io
+import shlex
+from botocore.exceptions import ClientError
+from . import aio
+
+__all__ = []
+
+# Where instances keep the verified scripts, by hash.  Commands run as root, so
+# the directory has to be owned by root and not writable by anyone else.
+REMOTE_CACHE_DIR = "/var/lib/ssm-toolkit/scripts"
+
+# The parameters of send_command are limited in size, larger compressed
+# scripts have to be staged in S3
+INLINE_LIMIT = 48 * 1024
+
+# Length of the base64 lines of inline payloads
+INLINE_LINE_LENGTH = 76
+
+# Validity of the presigned URLs the instances download the script from
+URL_EXPIRY = 12 * 60 * 60
+
+
+__all__.append("Script")
+
+
+class Script(object):
+
+    def __init__(self, content, name="script"):
+        self.name = name
+        self.content = content
+        self.sha256 = hashlib.sha256(content).hexdigest()
+        # mtime=0 keeps the payload of identical scripts identical
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as f:
+            f.write(content)
+        self.compressed = buffer.getvalue()
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls(f.read(), path)
+
+    def encoded(self):
+        return base64.b64encode(self.compressed).decode()
+
+    # Returns:
+    # The commands decoding the payload carried inline into the file $t
+    def inline_fetch(self):
+        encoded = self.encoded()
+        if len(encoded) > INLINE_LIMIT:
+            raise ValueError(f"Script {self.name} is {len(encoded)} bytes compressed and encoded, "
+                             f"more than the {INLINE_LIMIT} bytes that can be sent inline; use --script-bucket")
+        lines = [encoded[i:i + INLINE_LINE_LENGTH] for i in range(0, len(encoded), INLINE_LINE_LENGTH)]
+        return ["base64 -d <<'SSM_TOOLKIT_PAYLOAD' | gunzip -c > \"$t\""] + lines + ["SSM_TOOLKIT_PAYLOAD"]
+
+    # Returns:
+    # The commands downloading the payload from url into the file $t
+    @staticmethod
+    def url_fetch(url):
+        url = shlex.quote(url)
+        return [f"{{ curl -fsSL {url} || wget -qO- {url}; }} | gunzip -c > \"$t\""]
+
+    # Parameters:
+    # fetch - commands writing the script to the file $t, run only when the
+    #         instance has no verified copy of the script yet
+    #
+    # Returns:
+    # The AWS-RunShellScript commands verifying, caching and running the script
+    def bootstrap(self, fetch):
+        return [
+            "set -e",
+            "umask 077",
+            f"d={REMOTE_CACHE_DIR}",
+            f"h={self.sha256}",
+            'f="$d/$h"',
+            'verify() { [ "$(sha256sum "$1" | cut -d" " -f1)" = "$h" ]; }',
+            # Owned by the user running the bootstrap, not a symlink, and not
+            # writable by group or others, up to /var/lib
+            'private() { [ -d "$1" ] && [ ! -L "$1" ] && [ -O "$1" ] && [ -z "$(find "$1" -maxdepth 0 -perm /022)" ]; }',
+            'mkdir -p "$d"',
+            'if ! private "$d" || ! private "${d%/*}"; then echo "Script cache $d is not private, not running script $h" >&2; exit 1; fi',
+            # The file run is a private copy, verified after copying
+            't=$(mktemp "$d/.$h.XXXXXX")',
+            "trap 'rm -f \"$t\"' EXIT",
+            'if ! { [ -f "$f" ] && [ ! -L "$f" ] && cp "$f" "$t" && verify "$t"; }; then',
+        ] + fetch + [
+            'if ! verify "$t"; then echo "Script $h failed verification" >&2; exit 1; fi',
+            'c=$(mktemp "$d/.$h.XXXXXX")',
+            'cp "$t" "$c" && mv -f "$c" "$f"',
+            "fi",
+            "set +e",
+            # Interpreter of the shebang line, if any, so that noexec mounts work
+            'IFS= read -r first < "$t" || true',
+            'case "$first" in',
+            '"#!"*) ${first#??} "$t" ;;',
+            '*) sh "$t" ;;',
+            "esac",
+        ]
+
+    def inline_commands(self):
+        return self.bootstrap(self.inline_fetch())
+
+    # Uploads the payload to bucket under prefix unless it is already there
+    #
+    # Parameters:
+    # location - BUCKET or BUCKET/PREFIX
+    #
+    # Returns:
+    # The commands downloading the payload with a presigned URL
+    async def s3_commands(self, s3, location):
+        bucket, _, prefix = location.partition("/")
+        key = f"{prefix.strip('/')}/{self.sha256}.gz".lstrip("/")
+        try:
+            await aio.call(s3.head_object, Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                raise
+            await aio.call(s3.put_object, Bucket=bucket, Key=key, Body=self.compressed,
+                           ContentType="application/gzip", Metadata={"sha256": self.sha256})
+        url = s3.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=URL_EXPIRY)
+        return self.bootstrap(self.url_fetch(url))
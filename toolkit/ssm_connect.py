@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
 import argparse
-import boto3
+import asyncio
 import logging
 import os
 import sys
+import time
 from botocore.exceptions import ClientError
+from . import aio
+from . import fuzzy
+from . import timings
+from .filelock import file_lock
 from .common import *
 
 streamHandler = logging.StreamHandler()
@@ -20,7 +25,7 @@ logger.setLevel(logging.WARNING)
 
 def configure_session_client(profile, region):
     global session
-    session = boto3.Session(profile_name=profile, region_name=region)
+    session = get_session(profile, region)
 
 
 def parse_args(argv):
@@ -32,59 +37,154 @@ def parse_args(argv):
     add_general_parameters(parser)
     parser.add_argument('instance',
                         help='Instance ID, Name, Host name or IP address')
+    parser.add_argument('--no-provisioning-cache', action='store_true',
+                        help='Run CreateRunAsUser even if it succeeded for this instance and user recently')
     parser.description = 'Start SSM Shell Session to a given instance'
     args = parser.parse_args(argv)
     return args
 
 
-def start_session(instance_id, profile=None, region=None):
+# Seconds a successful CreateRunAsUser run on an instance is trusted for,
+# before the document is sent again on the next connection
+PROVISIONING_TTL = 12 * 60 * 60
+
+# Sessions ending sooner than this after relying on the provisioning cache are
+# taken as a failed login.  The exit status of the AWS CLI cannot tell: the
+# plugin does not return the status of the remote command, and fails the same
+# way for network or agent errors.
+LOGIN_FAILURE_SECONDS = 5
+
+
+# The instance lookup (EC2) and the caller identity (STS, usually cached) do not
+# depend on each other, so they run concurrently.  The instance is chosen by
+# the caller: the picker reads from the terminal, which has to happen on the
+# main thread, outside of the event loop.
+#
+# Returns:
+# The instance ids matching target and the caller identity
+async def prepare_session(target):
+    instances, identity = await asyncio.gather(
+        resolve_instances([target], session), get_caller_identity(session))
+    return instances[target], identity
+
+
+def start_session(instance_id, identity, profile=None, region=None, use_cache=True):
     extra_args = ""
     if profile:
         extra_args += f"--profile {profile} "
     if region:
         extra_args += f"--region {region} "
-    user = get_user()
+    user = get_user(identity)
+    provisioning_key = f"{identity['Account']}/{instance_id}/{user}"
     command = f'aws {extra_args} ssm start-session --target {instance_id} --document-name AWS-StartInteractiveCommand --parameters command="sudo su - {user}"'
     logger.info("Running: %s", command)
-    if create_user(instance_id, user):
-        os.system(command)
-        quit(0)
+
+    cached = use_cache and is_provisioned(provisioning_key)
+    if cached:
+        logger.info("User %s recently created on %s, skipping CreateRunAsUser", user, instance_id)
     else:
+        provision_user(instance_id, user, provisioning_key)
+    while True:
+        started = time.time()
+        with timings.phase("aws-cli"):
+            os.system(command)
+        if not cached or time.time() - started >= LOGIN_FAILURE_SECONDS:
+            break
+
+        # The user may have been removed since it was cached: create it again
+        # right away, and let the user decide whether the session failed
+        cached = False
+        set_provisioned(provisioning_key, False)
+        logger.warning("Session ended within %d seconds, running CreateRunAsUser for %s on %s in case "
+                       "the login failed", LOGIN_FAILURE_SECONDS, user, instance_id)
+        provision_user(instance_id, user, provisioning_key)
+        if not confirm_reconnect():
+            break
+    quit(0)
+
+
+# Returns:
+# True if the user answers yes to reconnecting, False without a terminal
+def confirm_reconnect():
+    if not fuzzy.can_prompt():
+        return False
+    try:
+        print("Reconnect? [Y/n] ", end="", file=sys.stderr, flush=True)
+        answer = sys.stdin.readline()
+    except KeyboardInterrupt:
+        print(file=sys.stderr)
+        return False
+    return bool(answer) and answer.strip().lower() in ("", "y", "yes")
+
+
+def provision_user(instance_id, user, provisioning_key):
+    with timings.phase("create_user", instance_id=instance_id):
+        created = create_user(instance_id, user, provisioning_key)
+    if not created:
         raise Exception(
             f"Failed to create user on instance {instance_id}")
 
 
-def create_user(instance_id, user):
+def create_user(instance_id, user, provisioning_key=None):
     ssm = session.client("ssm")
     try:
         response = ssm.send_command(InstanceIds=[
                                     instance_id], DocumentName="CreateRunAsUser", Parameters={"user": [user]})
         command_id = response["Command"]["CommandId"]
         if wait_for_command(ssm, command_id, instance_id):
+            if provisioning_key:
+                set_provisioned(provisioning_key)
             return True
     except ClientError:
         print("Document does not exist in account. Continuing")
         return True
 
 
-def get_user():
-    sts = session.client('sts')
-    identity = sts.get_caller_identity()
+def get_provisioning_file():
+    return os.path.join(get_toolkit_dir(), "provisioned.json")
+
+
+# Returns:
+# True if CreateRunAsUser succeeded for account/instance/user within PROVISIONING_TTL
+def is_provisioned(provisioning_key):
+    provisioned = read_json(get_provisioning_file(), {})
+    return time.time() - provisioned.get(provisioning_key, 0) < PROVISIONING_TTL
+
+
+def set_provisioned(provisioning_key, provisioned=True):
+    provisioning_file = get_provisioning_file()
+    with file_lock(f"{provisioning_file}.lock"):
+        now = time.time()
+        entries = {key: created for key, created in read_json(provisioning_file, {}).items()
+                   if now - created < PROVISIONING_TTL}
+        if provisioned:
+            entries[provisioning_key] = now
+        else:
+            entries.pop(provisioning_key, None)
+        write_json(provisioning_file, entries)
+
+
+def get_user(identity):
     arn = identity['Arn']
     return str.split(arn, "/")[-1]
 
 
 def main():
     args = parse_args(sys.argv[1:])
+    timings.configure(args)
     try:
         configure_session_client(args.profile, args.region)
-        instance_id = get_instance(args.instance, args.profile, args.region)
+        with timings.phase("prepare_session"):
+            instance_ids, identity = aio.run(prepare_session(args.instance))
+        instance_id = choose_instance(args.instance, instance_ids, session.profile_name,
+                                      session.region_name, interactive=True)
         if not instance_id:
             logger.warning(
                 f"Could not resolve Instance ID for {args.instance}")
             logger.warning(f"Ensure {args.instance} is registered in SSM")
             quit(1)
-        start_session(instance_id, profile=args.profile, region=args.region)
+        start_session(instance_id, identity, profile=args.profile, region=args.region,
+                      use_cache=not args.no_provisioning_cache)
     except Exception as e:
         logger.error(e)
         quit(1)
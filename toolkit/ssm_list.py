@@ -9,12 +9,15 @@
 # 2020-03-20 - SRE-1605 - Added command-line argument to filter results by instance tag
 
 import argparse
+import asyncio
 import botocore.exceptions
 from botocore.exceptions import ClientError
-import boto3
+from . import aio
+from .inventory import ExternalSort, InventoryRecord, get_inventory_cache_file, write_records
+from . import timings
+from . import toolkitd
 from .common import *
 import logging
-import os
 import re
 import sys
 
@@ -29,16 +32,29 @@ logger.addHandler(streamHandler)
 logger.setLevel(logging.WARNING)
 args = None
 
-def get_ssm_inventory():
-    instances = {}
-    
-    # Create boto3 client from session
-    session = boto3.Session(profile_name=args.profile, region_name=args.region)
+# Number of instance ids sent in a single describe_instances request
+DESCRIBE_BATCH_SIZE = 200
+
+# Parameters:
+# session - boto3 Session to list the instances with
+# filters - EC2 filter the instances have to match
+# profile - profile name stored in the records
+#
+# Yields:
+# Lists of InventoryRecord, one per batch of instances described in EC2.  The
+# batches are described while the SSM inventory is still being paginated, so
+# only the pages in flight are ever held besides the records.
+async def iter_ssm_inventory(session, filters=None, profile=None):
+    # Create boto3 clients from session
     ssm_client = session.client('ssm')
+    ec2_client = session.client('ec2')
+
+    host_names = {}
+    pending = set()
 
     # List instances from SSM
-    paginator = ssm_client.get_paginator('describe_instance_information')
-    response_iterator = paginator.paginate(
+    response_iterator = aio.paginate(
+        ssm_client, 'describe_instance_information',
         InstanceInformationFilterList=[
             {
                 'key': 'PingStatus',
@@ -48,108 +64,174 @@ def get_ssm_inventory():
             }
         ]
     )
-    for instance_info in response_iterator:
+    async for instance_info in response_iterator:
         for instance in instance_info['InstanceInformationList']:
             try:
                 # At the moment we only support EC2 Instances
                 assert instance["ResourceType"] == "EC2Instance"
 
-                # Add to the list
-                instance_id = instance['InstanceId']
-                instances.update({instance_id : {
-                    "InstanceId": instance_id,
-                    "HostName": instance.get("ComputerName", ""),
-                    "InstanceName": "",
-                    "Addresses": []
-                    }
-                })
+                # Add to the batch
+                host_names[instance['InstanceId']] = instance.get("ComputerName", "")
             except (AssertionError, KeyError, ValueError):
                 logger.debug("SSM inventory entity not recognised: %s", instance)
                 continue
 
-    instances = get_instance_details(instances)
+        # Add attributes from EC2, one request per batch of instance ids
+        if len(host_names) >= DESCRIBE_BATCH_SIZE:
+            pending.add(asyncio.ensure_future(
+                describe_instances(ec2_client, host_names, filters, profile)))
+            host_names = {}
+
+        for task in [task for task in pending if task.done()]:
+            pending.remove(task)
+            yield task.result()
+
+    if host_names:
+        pending.add(asyncio.ensure_future(
+            describe_instances(ec2_client, host_names, filters, profile)))
+    for task in asyncio.as_completed(pending):
+        yield await task
+
+
+# Returns:
+# Dict of instance id -> InventoryRecord
+async def get_ssm_inventory(session, filters=None, profile=None):
+    instances = {}
+    async for records in iter_ssm_inventory(session, filters, profile):
+        for record in records:
+            instances[record.instance_id] = record
     return instances
 
-    
-def get_instance_details(instances):
-    # Create boto3 client from session
-    session = boto3.Session(profile_name=args.profile, region_name=args.region)
-    ec2_client = session.client('ec2')
 
-    # Add attributes from EC2
-    filters = get_filters()
+# Parameters:
+# host_names - dict of instance id -> host name reported by SSM
+#
+# Returns:
+# List of InventoryRecord for the instances described by EC2.  Instances that
+# do not have a description are left out.
+async def describe_instances(ec2_client, host_names, filters, profile=None):
+    records = []
     try:
-        paginator = ec2_client.get_paginator('describe_instances')
-        response_iterator = paginator.paginate(InstanceIds=list(instances.keys()), Filters=[filters])
+        response_iterator = aio.paginate(
+            ec2_client, 'describe_instances', InstanceIds=list(host_names), Filters=[filters] if filters else [])
    
-        for reservations in response_iterator:
+        async for reservations in response_iterator:
             for reservation in reservations.get('Reservations', []):
                 for instance in reservation.get('Instances',[]):
                     instance_id = instance['InstanceId']
-                    if not instance_id in instances:
+                    if not instance_id in host_names:
                         continue
 
-                    # Find instance IPs
-                    instances[instance_id]['Addresses'].append(instance.get('PrivateIpAddress', ''))
-                    instances[instance_id]['Addresses'].append(instance.get('PublicIpAddress', ''))
-
-                    # Find instance name from tag Name
-                    for tag in instance.get('Tags',[]):
-                        if tag['Key'] == 'Name':
-                            instances[instance_id]['InstanceName'] = tag['Value']
-
-                    logger.debug("Updated instance: %s: %r", instance_id, instances[instance_id])
+                    tags = [(tag['Key'], tag['Value']) for tag in instance.get('Tags', [])]
+                    records.append(InventoryRecord(
+                        instance_id,
+                        host_name=host_names[instance_id],
+                        # Find instance name from tag Name
+                        instance_name=dict(tags).get('Name', ''),
+                        private_dns_name=instance.get('PrivateDnsName', ''),
+                        private_ip=instance.get('PrivateIpAddress', ''),
+                        public_ip=instance.get('PublicIpAddress', ''),
+                        tags=tags,
+                        profile=profile,
+                        region=ec2_client.meta.region_name
+                    ))
+                    logger.debug("Updated instance: %r", records[-1])
     except ClientError as c:
         # Handle edge case where Instance ID did not have the correct status and does not exist
         if c.response["Error"]["Code"] == "InvalidInstanceID.NotFound":
             id = re.search(r"The instance ID '(.*?)' does not exist", c.response["Error"]["Message"]).group(1)
-            del instances[id]
-            return get_instance_details(instances)
+            host_names = {k: v for k, v in host_names.items() if k != id}
+            if host_names:
+                return await describe_instances(ec2_client, host_names, filters, profile)
         else:
             raise Exception(c)
-    # Filter instances that do not have a description
-    for instance_id in list(instances):
-        if not instances[instance_id]['Addresses']:
-            del instances[instance_id]
-    return instances
+    return records
 
 # Method uses ArgumentParser to retrieve command-line arguments and display help interface
 def get_sys_args():
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument("--filters", metavar="FILTERS", nargs='+', help="Filter results using awscli syntax (--filters Name=key,Values=value1,value2 Name=tag:Name,Values=fqdn.domain.com )")
+    parser.add_argument("--profiles", metavar="PROFILE", nargs='+', help="List and merge the inventories of several profiles (accounts)")
+    parser.add_argument("--external-sort", action="store_true", help="Sort the list in temporary files instead of memory, for very large fleets")
     add_general_parameters(parser)
     
     return parser.parse_args()
 
 
+# Parameters:
+# profiles - profiles to list the inventory of, concurrently
+# filters - EC2 filter the instances have to match
+# add - called with every batch of InventoryRecord as it arrives
+async def fetch_inventory(profiles, filters, add):
+    async def fetch(profile):
+        # ssm-toolkitd only keeps the unfiltered inventory
+        inventory = await aio.call(toolkitd.get_inventory, profile, args.region) if not filters else None
+        if inventory is not None:
+            for record in inventory.values():
+                record.profile = profile
+            add(list(inventory.values()))
+            return
+        session = get_session(profile, args.region)
+        async for records in iter_ssm_inventory(session, filters, profile):
+            add(records)
+
+    await asyncio.gather(*[fetch(profile) for profile in profiles])
+
+
 def print_list():
-    cache_file = os.path.join(os.path.expanduser('~'),'.ssm_inventory_cache')
-    inventory  = get_ssm_inventory().values()
-    hostname_len = 1
-    instname_len = 1
+    cache_file = get_inventory_cache_file()
+    filters = get_filters()
+    profiles = args.profiles or [args.profile]
+    widths = {"profile": 1, "host_name": 1, "instance_name": 1}
+    count = 0
+
+    if args.external_sort:
+        items = ExternalSort()
+    else:
+        items = []
 
-    if not inventory:
+    # Column widths are tracked as the batches arrive so the records are only
+    # iterated once more, when printed
+    def add(records):
+        nonlocal count
+        for record in records:
+            widths["profile"] = max(widths["profile"], len(record.profile or "default"))
+            widths["host_name"] = max(widths["host_name"], len(record.host_name))
+            widths["instance_name"] = max(widths["instance_name"], len(record.instance_name))
+        count += len(records)
+        if args.external_sort:
+            items.add(records)
+        else:
+            items.extend(records)
+
+    with timings.phase("inventory"):
+        aio.run(fetch_inventory(profiles, filters, add))
+
+    if not count:
         logger.warning("No instances registered in SSM!")
         return
 
-    items = list(inventory)
-    items.sort(key=lambda x: x.get('InstanceName') or x.get('HostName'))
+    if not args.external_sort:
+        items.sort(key=InventoryRecord.sort_key)
 
     # try caching the list for later use
     try:
-        with open(cache_file, "w") as f:
-            for item in items:
-                f.write(f'{item}\n')
+        cache = open(cache_file, "w")
     except IOError:
         logger.error(f"File {cache_file} not accessible")
-        
-        
-    for item in items:
-        hostname_len = max(hostname_len, len(item['HostName']))
-        instname_len = max(instname_len, len(item['InstanceName']))
+        cache = None
 
-    for item in items:
-        print(f"{item['InstanceId']}   {item['HostName']:{hostname_len}}   {item['InstanceName']:{instname_len}}   {' '.join(item['Addresses'])}")
+    try:
+        for item in items:
+            if cache:
+                write_records(cache, [item])
+            line = f"{item.instance_id}   {item.host_name:{widths['host_name']}}   {item.instance_name:{widths['instance_name']}}   {' '.join(item.addresses)}"
+            if len(profiles) > 1:
+                line = f"{item.profile or 'default':{widths['profile']}}   {line}"
+            print(line)
+    finally:
+        if cache:
+            cache.close()
 
 
 def get_filters():
@@ -169,6 +251,7 @@ def main():
     global args
     
     args = get_sys_args()
+    timings.configure(args)
     try:
         print_list()
         quit(0)
@@ -7,14 +7,15 @@
 # Author: Justin Tang
 
 import argparse
-import boto3
+from . import aio
+from . import datachannel
+from . import ports
+from . import timings
 from .common import *
 import json
 import logging
 import os
 import platform
-import random
-import socket
 import signal
 import subprocess
 import sys
@@ -61,7 +62,7 @@ def add_required_parameters(parser):
     required.add_argument(
         '--target', '-t', help='Target instance:port to set up port forwarding to.  If the --remote option is specified, Target should only be the instance, without port', required=True)
     required.add_argument('--local', '-l',
-                          help='Local port to forward', required=True)
+                          help='Local port to forward.  By default the port used for the same target last time, or a free port', required=False)
 
     return required
 
@@ -70,6 +71,10 @@ def add_optional_parameters(parser):
     optional = parser.add_argument_group('Optional Parameters')
     optional.add_argument('--remote', '-r',
                           help='Remote instance:port to forward to', required=False)
+    optional.add_argument('--port-range', metavar='START-END', type=ports.parse_port_range,
+                          help='Range the local ports are chosen from when not given, e.g. 20000-20999')
+    optional.add_argument('--native', action='store_true',
+                          help='Serve the session in-process instead of running the AWS CLI and session-manager-plugin (requires the websockets package)')
 
     return optional
 
@@ -77,7 +82,7 @@ def add_optional_parameters(parser):
 def get_ssm_client(profile, region):
     profile = profile if profile != None else "default"
     region = region if region != None else "us-east-1"
-    session = boto3.Session(profile_name=profile, region_name=region)
+    session = get_session(profile, region)
     return session.client('ssm')
 
 
@@ -128,26 +133,48 @@ def port_forward_through_tunnel(session, local, remote):
     logger.debug(f"port forward command: {command}")
     sp = subprocess.Popen(command, executable=executable, shell=True)
 
-def port_forward(local, profile, region):
+# Parameters:
+# local - local port
+# sock - listening socket reserving the local port, handed over to the native
+#        client or closed right before the AWS CLI binds the port
+def port_forward(local, profile, region, native=False, sock=None):
+    if native:
+        if datachannel.is_available():
+            try:
+                return native_port_forward(local, sock)
+            except datachannel.DataChannelError as e:
+                logger.warning(f"Native port forwarding failed ({e}), falling back to the AWS CLI")
+        else:
+            logger.warning("Native port forwarding requires the websockets package "
+                           "(pip install aws-systems-manager-toolkit[native]), falling back to the AWS CLI")
     params = f'{{\\"portNumber\\":[\\"{port}\\"],\\"localPortNumber\\":[\\"{local}\\"]}}' if os.name == 'nt' else f'\'{json.dumps({"portNumber": [port], "localPortNumber": [local]})}\''
     extra_args = ""
     extra_args += f"--profile {profile} " if profile else ""
     extra_args += f"--region {region} " if region else ""
     command = f'aws ssm start-session --target {instance_id} --document-name AWS-StartPortForwardingSession --parameters {params} {extra_args}'
-    subprocess.call(command, shell=True)
+    if sock:
+        sock.close()
+    with timings.phase("aws-cli"):
+        subprocess.call(command, shell=True)
+
+
+# Same session as port_forward, served by toolkit.datachannel in this process
+def native_port_forward(local, sock=None):
+    session = datachannel.PortForwardSession(ssm, instance_id, port, int(local), sock)
+    try:
+        with timings.phase("native-session"):
+            aio.run(session.serve())
+    finally:
+        session.terminate()
 
 
 def validate_args(args):
     error = False
-    if int(args.local) < 1024:
+    if args.local and int(args.local) < 1024:
         logger.error(
             f"[ERROR] Cannot use a privileged port locally, found {args.local}")
         logger.error("See https://www.w3.org/Daemon/User/Installation/PrivilegedPorts.html")
         error = True
-    if not port_available(int(args.local)):
-        logger.error(
-            f"[ERROR] Local port {args.local} is not available.  Try again, or choose a different port.")
-        error = True
     if ':' not in args.target and args.remote == None:
         logger.error(
             f'Target not in correct format. Please specify ports. Found target = {args.target}')
@@ -174,7 +201,7 @@ def setup_globals(target, args):
 
     create_user_command_id = None
     ssm = get_ssm_client(args.profile, args.region)
-    instance_id = get_instance(target.split(":")[0], args.profile, args.region)
+    instance_id = get_instance(target.split(":")[0], args.profile, args.region, interactive=True)
     if not instance_id:
         raise Exception("Instance ID not found")
     port = target.split(":")[1] if len(target.split(":")) > 1 else None
@@ -210,36 +237,31 @@ def write_user_key(content):
     except IOError:
         logger.error(f"File '{temp_user_private_key}' not accessible")
 
-def get_available_local_port():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    found = False
-    while not found:
-        result = random.randint(1024,65535)
-        try:
-            sock.bind(("0.0.0.0", result))
-            found = True
-        except:
-            result = random.randint(1024,65535)
-    sock.close()
-    return str(result)
-
-def port_available(port):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        sock.bind(("0.0.0.0", port))
-        sock.close()
-        return True
-    except:
-        sock.close()
-        return False
+# Reserves the local port of the tunnel: the one given by the user, or the one
+# remembered for the target, or a free one
+def reserve_local_port(args):
+    if args.local:
+        return ports.bind(int(args.local))
+    key = f"{args.profile or 'default'}/{args.region or ''}/{args.target}/{args.remote or ''}"
+    sock = ports.reserve(key, args.port_range)
+    logger.info(f"Using local port {sock.getsockname()[1]}")
+    return sock
 
 def main():
     global port, create_user_command_id
     setup_signal_handlers()
     args = parse_args(sys.argv[1:])
+    timings.configure(args)
     error = validate_args(args)
     if error:
         return
+    try:
+        local_socket = reserve_local_port(args)
+    except OSError as e:
+        logger.error(
+            f"[ERROR] Local port {args.local or ''} is not available ({e}).  Try again, or choose a different port.")
+        return
+    args.local = str(local_socket.getsockname()[1])
     try:
         setup_globals(args.target, args)
     except Exception as e:
@@ -260,20 +282,23 @@ def main():
         if wait_for_command(ssm, create_user_command_id, instance_id):
             port = "22"
             # used by AWS-StartPortForwardingSession to establish the port fowarding session
-            local_session_port = get_available_local_port()
+            session_socket = ports.reserve(port_range=args.port_range)
+            local_session_port = str(session_socket.getsockname()[1])
             # retrieve the private key from the output of the AWS-RunShellScript commands above
             pem_key = get_output_from_command(create_user_command_id)
             # store private key in a temporary local file with appropriate permissions for ssh use
             write_user_key(pem_key)
             # Need to run this command first because the AWS-StartPortForwardingSession document is a blocks us from running it afterwards
+            # ssh binds the local port itself
+            local_socket.close()
             port_forward_through_tunnel(local_session_port, args.local, args.remote)
             # establish the local tunnel, which will trigger the second ssh tunnel creation once the port is listening
-            port_forward(local_session_port, args.profile, args.region)
+            port_forward(local_session_port, args.profile, args.region, args.native, session_socket)
         else:
             logger.warning(f"Could not confirm the successful creation of user tunneluser_{uuid} on {instance_id}")
             return
     else:
-        port_forward(args.local, args.profile, args.region)
+        port_forward(args.local, args.profile, args.region, args.native, local_socket)
 
 
 if __name__ == "__main__":
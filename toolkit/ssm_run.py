@@ -5,20 +5,29 @@
 # Author: Justin Tang
 
 import argparse
-import boto3
+import asyncio
 import botocore.exceptions
 from botocore.exceptions import ClientError
 import json
 import subprocess
 import sys
-import time
+from . import aio
+from . import journal
+from . import query
+from . import script
+from . import ssm_list
+from . import timings
+from . import toolkitd
 from .common import *
 from sys import platform
 
+# send_command accepts at most 50 instance ids per request
+SEND_COMMAND_BATCH_SIZE = 50
+
 
 def configure_session_client(profile, region):
     global session
-    session = boto3.Session(profile_name=profile, region_name=region)
+    session = get_session(profile, region)
 
 
 def parse_args(argv):
@@ -28,68 +37,269 @@ def parse_args(argv):
 
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter, usage=usage(), add_help=False)
-    parser.add_argument("instances", nargs='+')
+    parser.add_argument("instances", nargs='*')
     add_general_parameters(parser)
     add_required_parameters(parser)
+    add_script_parameters(parser)
+    add_target_parameters(parser)
+    add_journal_parameters(parser)
     args = parser.parse_args(argv)
 
+    if not (args.show or args.retry_failed):
+        selectors = [selector for selector in (args.instances, args.targets, args.query) if selector]
+        if len(selectors) != 1 or bool(args.commands) == bool(args.script):
+            parser.error("one of --commands or --script, and one of instances, --targets or --query are required")
+        if args.script_bucket and not args.script:
+            parser.error("--script-bucket requires --script")
+    try:
+        args.targets = parse_targets(args.targets or [])
+        args.query = query.parse_query(args.query or [])
+    except ValueError as e:
+        parser.error(str(e))
+
     return args
 
 
 def usage():
-    msg = "ssm-run instances [instances ...] [--help] [--profile PROFILE] [--region REGION] --commands COMMANDS [COMMANDS ...]"
+    msg = ("ssm-run instances [instances ...] [--help] [--profile PROFILE] [--region REGION] --commands COMMANDS [COMMANDS ...]\n"
+           "       ssm-run --targets KEY=VALUE[,VALUE] [KEY=VALUE ...] [--profile PROFILE] [--region REGION] --commands COMMANDS [COMMANDS ...]\n"
+           "       ssm-run --query TERM [TERM ...] [--profile PROFILE] [--region REGION] --commands COMMANDS [COMMANDS ...]\n"
+           "       ssm-run instances [instances ...] [--profile PROFILE] [--region REGION] --script FILE [--script-bucket BUCKET[/PREFIX]]\n"
+           "       ssm-run [--profile PROFILE] [--region REGION] --retry-failed RUN_ID\n"
+           "       ssm-run --show RUN_ID")
     return msg
 
 
 def add_required_parameters(parser):
     required = parser.add_argument_group('Required Parameters')
     required.add_argument(
-        '--commands', '-c', help='Commands to run against instances', required=True, nargs='+')
+        '--commands', '-c', help='Commands to run against instances', nargs='+')
     return required
 
 
-def get_response(command_id):
-    command_check = get_command_status(command_id)
-    while True:
-        res = [ci["Status"] in ["Success", "Failed"]
-               for ci in command_check["CommandInvocations"]]
-        status = all(res)
-        if len(command_check["CommandInvocations"]) == 0 or not status:
-            time.sleep(1)
-            command_check = get_command_status(command_id)
-        else:
-            return command_check
+def add_script_parameters(parser):
+    script_group = parser.add_argument_group('Script Parameters')
+    script_group.add_argument(
+        '--script', metavar='FILE', help='Run a local script instead of --commands, sent compressed and cached on the instances by hash')
+    script_group.add_argument(
+        '--script-bucket', metavar='BUCKET[/PREFIX]',
+        help='Stage the script in S3 and let the instances download it, for scripts too large to send inline')
+    return script_group
+
+
+def add_target_parameters(parser):
+    target_group = parser.add_argument_group('Target Parameters')
+    target_group.add_argument(
+        '--targets', metavar='KEY=VALUE', nargs='+',
+        help='Let SSM select the instances, e.g. tag:Role=web or resource-groups:Name=web-servers (all have to match)')
+    target_group.add_argument(
+        '--query', metavar='TERM', nargs='+',
+        help='Select the instances from the inventory with KEY=GLOB, KEY!=GLOB or KEY~REGEX terms (all have to match), '
+             'KEY is one of id, name, host, dns, ip, private-ip, public-ip or tag:TAG-KEY')
+    return target_group
+
+
+# Converts KEY=VALUE[,VALUE] arguments to send_command Targets
+def parse_targets(arguments):
+    targets = []
+    for argument in arguments:
+        key, _, values = argument.partition("=")
+        if not key or not values:
+            raise ValueError(f"Invalid target '{argument}', expected KEY=VALUE[,VALUE]")
+        targets.append({"Key": key, "Values": values.split(",")})
+    return targets
+
+
+def add_journal_parameters(parser):
+    journal_group = parser.add_argument_group('Run Journal Parameters')
+    journal_group.add_argument(
+        '--show', metavar='RUN_ID', help='Show the recorded output of a previous run')
+    journal_group.add_argument(
+        '--retry-failed', metavar='RUN_ID', help='Re-run the commands of a previous run on the instances that failed or did not finish')
+    return journal_group
+
+
+async def send_command(run, instance_ids, commands):
+    response = await aio.call(
+        ssm.send_command, InstanceIds=instance_ids, DocumentName="AWS-RunShellScript", Parameters={'commands': commands})
+    command_id = response["Command"]["CommandId"]
+    journal.record_command(run, command_id, instance_ids)
+    invocations = await aio.wait_for_invocations(ssm, command_id, expected=len(instance_ids))
+    journal.record_invocations(run, invocations)
+    return [ci["InstanceId"] for ci in invocations]
+
+
+# Sends the commands once with Targets: SSM selects the instances itself, so
+# there is nothing to resolve and no batching
+async def send_targeted_command(run, targets, commands):
+    response = await aio.call(
+        ssm.send_command, Targets=targets, DocumentName="AWS-RunShellScript", Parameters={'commands': commands})
+    command_id = response["Command"]["CommandId"]
+    journal.record_command(run, command_id, [])
+    invocations = None
+    try:
+        invocations = await aio.wait_for_targets(ssm, command_id)
+        return [ci["InstanceId"] for ci in invocations]
+    finally:
+        if invocations is None:
+            # Interrupted or failed while waiting: record the instances SSM
+            # selected so far, so that the run can be shown and retried
+            try:
+                invocations = await aio.list_command_invocations(ssm, command_id)
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+                invocations = []
+        journal.record_invocations(run, invocations, describe_targets(targets))
+        journal.save_run(run)
+
+
+def describe_targets(targets):
+    return " ".join(f'{target["Key"]}={",".join(target["Values"])}' for target in targets)
 
 
-def get_instance_ids(instances, profile, region):
-    i = [{get_instance(instance, profile, region): instance}
-         for instance in instances]
-    # remove any invalid or instances not found
-    return {k: v for d in i for k, v in d.items() if k != None}
+# Returns:
+# Dict of instance id -> instance name for the instances of the inventory
+# (ssm-toolkitd, or fetched once) matching every query term
+async def select_instances(terms, profile, region):
+    inventory = await aio.call(toolkitd.get_inventory, profile, region)
+    if inventory is None:
+        inventory = await ssm_list.get_ssm_inventory(session, profile=profile)
+    return {record.instance_id: record.instance_name or record.host_name
+            for record in query.select(inventory.values(), terms)}
 
 
-def get_command_status(command_id):
-    command_check = ssm.list_command_invocations(
-        CommandId=command_id, Details=True)
-    return command_check
+# Stages the script once and returns the bootstrap commands that every batch
+# sends instead of the script itself
+async def stage_script(path, bucket=None):
+    payload = script.Script.load(path)
+    if bucket:
+        commands = await payload.s3_commands(session.client('s3'), bucket)
+    else:
+        commands = payload.inline_commands()
+    print(f"Script {path}: {len(payload.content)} bytes, {len(payload.compressed)} compressed, "
+          f"sha256 {payload.sha256}", file=sys.stderr)
+    return commands
+
+
+def print_output(run, instance_ids):
+    for instance_id in instance_ids:
+        entry = run["Invocations"][instance_id]
+        status = f' | {entry["Status"]}' if entry["Status"] != "Success" else ""
+        print(f'{entry["Target"]} | {instance_id}{status}')
+        for output in entry["Output"]:
+            print(output)
+
+
+# Sends the commands in batches of SEND_COMMAND_BATCH_SIZE instances and prints
+# the output of each batch as soon as all of its invocations have finished
+async def run_commands(run, instance_ids):
+    pending = [send_command(run, batch, run["Commands"])
+               for batch in aio.chunks(instance_ids, SEND_COMMAND_BATCH_SIZE)]
+    print("\n Output\n--------")
+    try:
+        for batch in asyncio.as_completed(pending):
+            print_output(run, await batch)
+    finally:
+        journal.save_run(run)
+
+
+# Asks SSM for the invocations the journal of run has not seen finishing, e.g.
+# because the previous ssm-run was interrupted, with one call per command.  The
+# instances SSM selected for the command of a --targets run are only known
+# from its invocations, so that command is always asked for.
+async def refresh_run(run):
+    running = journal.get_running(run)
+    target = None
+    if run.get("Targets") and run["CommandIds"]:
+        target = describe_targets(run["Targets"])
+        running.setdefault(run["CommandIds"][0], [])
+    results = await asyncio.gather(*[aio.list_command_invocations(ssm, command_id) for command_id in running])
+    for (command_id, instance_ids), invocations in zip(running.items(), results):
+        journal.refresh_invocations(run, command_id, instance_ids, invocations,
+                                    target if command_id == run["CommandIds"][0] else None)
+    journal.save_run(run)
+
+
+# Sends the commands of run with its Targets and prints the output
+def run_targeted(run):
+    with timings.phase("run_commands"):
+        instance_ids = aio.run(send_targeted_command(run, run["Targets"], run["Commands"]))
+    if instance_ids:
+        print("\n Output\n--------")
+        print_output(run, instance_ids)
+    else:
+        print("No instances matched the targets")
+    print(f"\nRun ID: {run['RunId']}", file=sys.stderr)
+
+
+def get_run(run_id):
+    run = journal.load_run(run_id)
+    if not run:
+        print(f"No run found with RUN_ID {run_id}")
+        quit(1)
+    return run
 
 
 def main():
     args = parse_args(sys.argv[1:])
-    configure_session_client(args.profile, args.region)
+    timings.configure(args)
+    if args.show:
+        run = get_run(args.show)
+        if not run["Invocations"]:
+            print(f"No instances recorded for run {run['RunId']}, use --retry-failed to send its commands")
+            quit(0)
+        print("\n Output\n--------")
+        print_output(run, run["Invocations"])
+        quit(0)
+
+    if args.retry_failed:
+        run = get_run(args.retry_failed)
+        configure_session_client(args.profile or run["Profile"], args.region or run["Region"])
+    else:
+        run = None
+        configure_session_client(args.profile, args.region)
     global ssm
     try:
         ssm = session.client('ssm')
-        instances = get_instance_ids(args.instances, args.profile, args.region)
-        response = ssm.send_command(
-            InstanceIds=list(instances.keys()), DocumentName="AWS-RunShellScript", Parameters={'commands': args.commands})
-        command_id = response["Command"]["CommandId"]
-        command_check = get_response(command_id)
-        print("\n Output\n--------")
-        for ci in command_check["CommandInvocations"]:
-            print(f'{instances[ci["InstanceId"]]} | {ci["InstanceId"]}')
-            for command in ci["CommandPlugins"]:
-                print(command["Output"])
+        if args.script:
+            with timings.phase("stage_script"):
+                try:
+                    args.commands = aio.run(stage_script(args.script, args.script_bucket))
+                except (IOError, ValueError) as e:
+                    print(e)
+                    quit(1)
+        if run:
+            with timings.phase("refresh_run"):
+                aio.run(refresh_run(run))
+            if run.get("Targets") and not run["CommandIds"]:
+                # The command of the --targets run was never sent
+                run_targeted(run)
+                return
+            running = sum(len(instance_ids) for instance_ids in journal.get_running(run).values())
+            if running:
+                print(f"{running} instances of run {run['RunId']} are still running the commands, not retrying them")
+            instances = journal.get_unfinished(run)
+            if not instances:
+                if not running:
+                    print(f"All instances of run {run['RunId']} succeeded, nothing to retry")
+                quit(0)
+        elif args.targets:
+            run = journal.new_run(args.commands, {}, args.profile, args.region, targets=args.targets)
+            run_targeted(run)
+            return
+        else:
+            with timings.phase("resolve"):
+                if args.query:
+                    instances = aio.run(select_instances(args.query, args.profile, args.region))
+                    if not instances:
+                        print("No instances matched the query")
+                else:
+                    instances = aio.run(get_instances(args.instances, session))
+            if not instances:
+                quit(1)
+            run = journal.new_run(args.commands, instances, args.profile, args.region)
+        with timings.phase("run_commands", instances=len(instances)):
+            aio.run(run_commands(run, list(instances)))
+        print(f"\nRun ID: {run['RunId']}", file=sys.stderr)
     except (botocore.exceptions.BotoCoreError,
             botocore.exceptions.ClientError) as e:
         print(e)
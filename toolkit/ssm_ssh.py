@@ -14,6 +14,7 @@ import botocore.exceptions
 import logging
 import os
 import re
+from . import timings
 from .common import *
 import platform
 from subprocess import Popen, PIPE
@@ -75,8 +76,9 @@ def start_session(arg_list):
 
     logger.debug("Running: %s", command)
     logger.debug("Executable environment: %s", executable)
-    subproc = Popen([command], executable=executable, shell=True)
-    response = subproc.communicate()[1]
+    with timings.phase("ssh"):
+        subproc = Popen([command], executable=executable, shell=True)
+        response = subproc.communicate()[1]
 
     return response
 
@@ -138,6 +140,7 @@ def get_destination(args):
 def main():
     global args
     args = get_sys_args()
+    timings.configure(args[0])
     logger.debug(f"arg list: {args}, length: {len(args[1])}")
     destination = get_destination(args[1])
 
@@ -155,7 +158,7 @@ def main():
         if destination:
             destination = format_destination(destination)
             target = destination[0] if len(destination) < 2 else destination[1]
-            instance = get_instance(target, args[0].profile, args[0].region)
+            instance = get_instance(target, args[0].profile, args[0].region, interactive=True)
 
             if instance:
                 vars(args[0])["params"] = args[0].params.replace(
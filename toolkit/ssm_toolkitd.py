@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+# Background daemon keeping boto3 sessions and the SSM inventory warm in memory.
+#
+# The inventory of every (profile, region) that was queried is refreshed in the
+# background from describe_instance_information / describe_instances, and
+# target resolution, inventory listing and completion queries are answered
+# from memory over a Unix domain socket (see toolkit.toolkitd for the client).
+# The other tools use it automatically when it is running.
+#
+# Email: SRE@vonage.com
+
+import argparse
+import asyncio
+import boto3
+import fnmatch
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from . import aio
+from . import fuzzy
+from . import ssm_list
+from . import toolkitd
+from .common import *
+from .common import format_filters
+
+streamHandler = logging.StreamHandler()
+formatter = logging.Formatter(
+    "[%(name)s] %(levelname)s: %(message)s"
+)
+streamHandler.setFormatter(formatter)
+logger = logging.getLogger("ssm-toolkitd")
+logger.addHandler(streamHandler)
+logger.setLevel(logging.INFO)
+
+# Seconds between two refreshes of an inventory
+REFRESH_INTERVAL = 60
+
+# Inventories not queried for this many seconds are no longer refreshed
+IDLE_TIMEOUT = 60 * 60
+
+# Maximum number of completions returned for a prefix
+MAX_COMPLETIONS = 100
+
+inventories = {}
+
+# Region of every profile when the request does not give one, from the AWS config
+profile_regions = {}
+
+
+class Inventory(object):
+
+    def __init__(self, profile, region):
+        self.profile = profile
+        self.region = region
+        self.session = None
+        self.instances = {}
+        self.index = None
+        self.updated = 0
+        self.used = time.time()
+        self.loaded = asyncio.ensure_future(self.refresh())
+
+    async def refresh(self):
+        start = time.time()
+        try:
+            if self.session is None:
+                # Off the event loop: building the session reads the AWS
+                # configuration files
+                self.session = await aio.call(get_session, self.profile, self.region)
+            instances = await ssm_list.get_ssm_inventory(self.session, profile=self.profile)
+        except Exception as e:
+            logger.error("Refreshing inventory for profile %s in %s failed: %s",
+                         self.profile, self.region, e)
+            return
+        self.instances = instances
+        self.index = None
+        self.updated = time.time()
+        logger.info("Refreshed inventory for profile %s in %s: %d instances in %.2fs",
+                    self.profile, self.region, len(instances), self.updated - start)
+
+
+# Region the tools use for profile when no region is given, the same as
+# common.get_session would resolve
+def get_profile_region(profile):
+    if profile not in profile_regions:
+        profile_regions[profile] = boto3.Session(profile_name=profile).region_name
+    return profile_regions[profile]
+
+
+# Returns:
+# The Inventory of profile and region, which starts loading on first use
+def load_inventory(profile, region):
+    profile = None if profile == "default" else profile
+    region = region or get_profile_region(profile)
+    key = (profile, region)
+    if key not in inventories:
+        inventories[key] = Inventory(profile, region)
+    inventory = inventories[key]
+    inventory.used = time.time()
+    return inventory
+
+
+# Requests for an inventory that is still loading fail right away instead of
+# waiting for it, so that the tools fall back to the AWS APIs without waiting
+# for their timeout, and the next requests find the inventory loaded
+#
+# Returns:
+# The loaded Inventory of profile and region
+async def get_inventory(profile, region):
+    inventory = load_inventory(profile, region)
+    if not inventory.updated:
+        raise Exception(f"Inventory for profile {inventory.profile} in {inventory.region} is not loaded yet")
+    return inventory
+
+
+# Same matching as the EC2 filters built by common.format_filters
+def matches(instance, filters):
+    for f in filters:
+        values = f['Values']
+        if f['Name'] == 'private-ip-address':
+            value = instance.private_ip
+        elif f['Name'] == 'ip-address':
+            value = instance.public_ip
+        elif f['Name'] == 'private-dns-name':
+            value = instance.private_dns_name
+        else:
+            value = instance.instance_name
+        if not any(fnmatch.fnmatchcase(value, pattern) for pattern in values):
+            return False
+    return True
+
+
+async def resolve(request):
+    inventory = await get_inventory(request.get("Profile"), request.get("Region"))
+    filters = format_filters(request["Target"])
+    return {"InstanceIds": [instance_id for instance_id, instance in inventory.instances.items()
+                            if matches(instance, filters)]}
+
+
+async def list_inventory(request):
+    inventory = await get_inventory(request.get("Profile"), request.get("Region"))
+    return {"Instances": [instance.to_dict() for instance in inventory.instances.values()],
+            "Updated": inventory.updated}
+
+
+async def search(request):
+    inventory = await get_inventory(request.get("Profile"), request.get("Region"))
+    # Built on first search after every refresh, then reused
+    if inventory.index is None:
+        inventory.index = fuzzy.TrigramIndex(inventory.instances.values())
+    results = inventory.index.search(request["Query"], request.get("Limit") or fuzzy.MAX_CHOICES)
+    return {"Instances": [record.to_dict() for record, score in results]}
+
+
+async def complete(request):
+    inventory = await get_inventory(request.get("Profile"), request.get("Region"))
+    prefix = request.get("Prefix", "")
+    completions = set()
+    for instance in inventory.instances.values():
+        for value in [instance.instance_id, instance.instance_name,
+                      instance.host_name, *instance.addresses]:
+            if value and value.startswith(prefix):
+                completions.add(value)
+    return {"Completions": sorted(completions)[:MAX_COMPLETIONS]}
+
+
+async def ping(request):
+    return {"Pong": True}
+
+
+ACTIONS = {
+    "ping": ping,
+    "resolve": resolve,
+    "inventory": list_inventory,
+    "complete": complete,
+    "search": search,
+}
+
+
+async def handle_client(reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                response = await ACTIONS[request["Action"]](request)
+            except Exception as e:
+                logger.debug("Request %r failed: %s", line, e)
+                response = {"Error": str(e)}
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def refresh_inventories():
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        for key, inventory in list(inventories.items()):
+            if time.time() - inventory.used > IDLE_TIMEOUT:
+                logger.info("Dropping idle inventory for profile %s in %s", *key)
+                del inventories[key]
+            else:
+                await inventory.refresh()
+
+
+async def serve(socket_path, profiles, region=None):
+    server = await asyncio.start_unix_server(handle_client, path=socket_path)
+    os.chmod(socket_path, 0o600)
+    logger.info("Listening on %s", socket_path)
+    try:
+        for profile in profiles:
+            await load_inventory(profile, region).loaded
+        await refresh_inventories()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+def is_running(socket_path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+def parse_args(argv):
+    """
+    Parse command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, add_help=False)
+    parser.description = 'Keep the SSM inventory warm and serve it to the other ssm-* tools'
+    add_general_parameters(parser)
+    optional = parser.add_argument_group('Optional Parameters')
+    optional.add_argument('--preload', metavar='PROFILE', nargs='+', default=[],
+                          help='Additional profiles to load the inventory of on start up')
+    optional.add_argument('--refresh', type=int, default=REFRESH_INTERVAL,
+                          help='Seconds between two inventory refreshes')
+    optional.add_argument('--complete', metavar='PREFIX',
+                          help='Print the targets starting with PREFIX known to the running daemon and exit')
+    return parser.parse_args(argv)
+
+
+def main():
+    global REFRESH_INTERVAL
+    args = parse_args(sys.argv[1:])
+
+    if args.complete is not None:
+        for completion in toolkitd.complete(args.complete, args.profile, args.region) or []:
+            print(completion)
+        quit(0)
+
+    if not hasattr(socket, "AF_UNIX"):
+        logger.error("Unix domain sockets are not supported on this platform")
+        quit(1)
+
+    socket_path = toolkitd.get_socket_path()
+    get_toolkit_dir()
+    if os.path.exists(socket_path):
+        if is_running(socket_path):
+            logger.error("ssm-toolkitd is already running on %s", socket_path)
+            quit(1)
+        os.remove(socket_path)
+
+    REFRESH_INTERVAL = args.refresh
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        aio.run(serve(socket_path, [args.profile] + args.preload, args.region))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# Timing and API call instrumentation for the SSM tools
+#
+# Enabled with the --timings (summary on stderr) and --trace FILE (Chrome trace
+# JSON, open it in chrome://tracing or https://ui.perfetto.dev) general
+# parameters.  Records the time spent in each phase of a tool (Python startup,
+# session creation, instance resolution, waiting for commands, the aws CLI
+# subprocess, ...) and, through botocore event hooks, the latency, retries and
+# number of calls of every AWS API operation.
+#
+# Email: SRE@vonage.com
+
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+__all__ = []
+
+# Wall clock time toolkit was imported at, used when the process start time
+# cannot be read from the OS
+IMPORT_TIME = time.time()
+
+enabled = False
+trace_file = None
+events = []
+api_calls = {}
+_lock = threading.Lock()
+
+
+# Best effort start time of the current process, so that interpreter startup
+# and imports are accounted for
+def get_process_start_time():
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (IOError, OSError, ValueError, IndexError, StopIteration, AttributeError):
+        return IMPORT_TIME
+
+
+def add_event(name, category, start, duration, args=None):
+    with _lock:
+        events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": int(start * 1e6),
+            "dur": int(duration * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args or {}
+        })
+
+
+__all__.append("add_timing_parameters")
+
+
+def add_timing_parameters(group):
+    group.add_argument('--timings', action='store_true',
+                       help='Print time spent per phase and per AWS API call on exit')
+    group.add_argument('--trace', metavar='FILE', type=str,
+                       help='Write a Chrome trace of phases and AWS API calls to FILE on exit')
+
+
+__all__.append("configure")
+
+
+# Enables the instrumentation when --timings or --trace was given
+def configure(args):
+    global enabled, trace_file
+    if enabled or not (getattr(args, "timings", False) or getattr(args, "trace", None)):
+        return
+    enabled = True
+    trace_file = args.trace
+    start = get_process_start_time()
+    add_event("startup", "phase", start, time.time() - start)
+    atexit.register(report, args.timings)
+
+
+__all__.append("phase")
+
+
+@contextlib.contextmanager
+def phase(name, **args):
+    if not enabled:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_event(name, "phase", start, time.time() - start, args)
+
+
+__all__.append("register")
+
+
+# Adds the botocore event hooks recording API calls made by clients of session
+def register(session):
+    if not enabled:
+        return
+
+    def get_stats(event_name):
+        operation = ".".join(event_name.split(".")[1:3])
+        return api_calls.setdefault(operation, {
+            "calls": 0, "attempts": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0})
+
+    def before_call(context, **kwargs):
+        context["timings_start"] = time.time()
+
+    def before_send(event_name, **kwargs):
+        with _lock:
+            get_stats(event_name)["attempts"] += 1
+
+    def after_call(event_name, context, http_response=None, error=False, **kwargs):
+        start = context.get("timings_start")
+        if start is None:
+            return
+        error = error or (http_response is not None and http_response.status_code >= 300)
+        duration = time.time() - start
+        with _lock:
+            stats = get_stats(event_name)
+            stats["calls"] += 1
+            stats["errors"] += int(error)
+            stats["seconds"] += duration
+            stats["max_seconds"] = max(stats["max_seconds"], duration)
+        add_event(".".join(event_name.split(".")[1:3]), "api", start, duration)
+
+    def after_call_error(event_name, context, **kwargs):
+        after_call(event_name, context, error=True)
+
+    session.events.register("before-call", before_call)
+    session.events.register("before-send", before_send)
+    session.events.register("after-call", after_call)
+    session.events.register("after-call-error", after_call_error)
+
+
+def print_summary():
+    end = time.time()
+    start = get_process_start_time()
+    phases = {}
+    for event in events:
+        if event["cat"] == "phase":
+            count, seconds = phases.get(event["name"], (0, 0.0))
+            phases[event["name"]] = (count + 1, seconds + event["dur"] / 1e6)
+
+    print(f"\nTimings (total {end - start:.3f}s)", file=sys.stderr)
+    print(f"  {'Phase':40} {'count':>6} {'seconds':>9}", file=sys.stderr)
+    for name, (count, seconds) in phases.items():
+        print(f"  {name:40} {count:6} {seconds:9.3f}", file=sys.stderr)
+
+    if api_calls:
+        # Attempts beyond the number of calls were retries; for paginated
+        # operations the number of calls is the number of pages fetched
+        print(f"  {'API call':40} {'calls':>6} {'retries':>7} {'errors':>6} {'seconds':>9} {'max':>7}", file=sys.stderr)
+        for name, stats in sorted(api_calls.items(), key=lambda x: -x[1]["seconds"]):
+            retries = max(0, stats["attempts"] - stats["calls"])
+            print(f"  {name:40} {stats['calls']:6} {retries:7} {stats['errors']:6} {stats['seconds']:9.3f} {stats['max_seconds']:7.3f}", file=sys.stderr)
+
+
+def write_trace():
+    try:
+        with open(trace_file, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                       "otherData": {"api_calls": api_calls}}, f)
+    except IOError:
+        print(f"File {trace_file} not accessible", file=sys.stderr)
+
+
+def report(summary):
+    if summary:
+        print_summary()
+    if trace_file:
+        write_trace()
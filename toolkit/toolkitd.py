@@ -0,0 +1,107 @@
+# Client side of the ssm-toolkitd daemon
+#
+# When ssm-toolkitd is running it keeps sessions and the SSM inventory warm in
+# memory and answers queries on a Unix domain socket.  The tools use it
+# transparently: every function here returns None when the daemon is not
+# running or cannot answer, and the caller falls back to the AWS APIs.
+#
+# Email: SRE@vonage.com
+
+import json
+import logging
+import os
+import socket
+from .inventory import InventoryRecord
+
+__all__ = []
+
+
+logger = logging.getLogger()
+
+# Seconds to wait for an answer before falling back to the AWS APIs
+TIMEOUT = 2
+
+
+__all__.append("get_socket_path")
+
+
+def get_socket_path():
+    return os.path.join(os.path.expanduser('~'), '.ssm_toolkit', 'toolkitd.sock')
+
+
+__all__.append("query")
+
+
+# Sends one request to the daemon.
+#
+# Returns:
+# The response dict, or None if the daemon is not available or failed
+def query(request):
+    if not hasattr(socket, "AF_UNIX") or os.environ.get("SSM_TOOLKIT_DAEMON") == "0":
+        return None
+    socket_path = get_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(TIMEOUT)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline())
+    except (OSError, ValueError) as e:
+        logger.debug("ssm-toolkitd not available: %s", e)
+        return None
+    if "Error" in response:
+        logger.debug("ssm-toolkitd error: %s", response["Error"])
+        return None
+    return response
+
+
+__all__.append("resolve")
+
+
+# Returns:
+# List of instance ids matching target in the daemon's inventory, None if unknown
+def resolve(target, profile=None, region=None):
+    response = query({"Action": "resolve", "Target": target,
+                      "Profile": profile, "Region": region})
+    if response and response["InstanceIds"]:
+        return response["InstanceIds"]
+    return None
+
+
+__all__.append("get_inventory")
+
+
+# Returns:
+# Dict of instance id -> InventoryRecord, as built by ssm_list.get_ssm_inventory
+def get_inventory(profile=None, region=None):
+    response = query({"Action": "inventory", "Profile": profile, "Region": region})
+    if response is None:
+        return None
+    records = [InventoryRecord.from_dict(instance) for instance in response["Instances"]]
+    return {record.instance_id: record for record in records}
+
+
+__all__.append("search")
+
+
+# Returns:
+# Up to limit InventoryRecord fuzzy matching text, best match first, None if
+# the daemon cannot answer
+def search(text, profile=None, region=None, limit=None):
+    response = query({"Action": "search", "Query": text, "Limit": limit,
+                      "Profile": profile, "Region": region})
+    if response is None:
+        return None
+    return [InventoryRecord.from_dict(instance) for instance in response["Instances"]]
+
+
+__all__.append("complete")
+
+
+def complete(prefix, profile=None, region=None):
+    response = query({"Action": "complete", "Prefix": prefix,
+                      "Profile": profile, "Region": region})
+    return response["Completions"] if response else None